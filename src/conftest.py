@@ -0,0 +1,2 @@
+# (at the root of the 'src' package, so pytest puts this directory on sys.path and the tests
+# import src.* as the notebooks do)
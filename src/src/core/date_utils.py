@@ -18,3 +18,36 @@ def daterange(start, step=None, stop=None, count=None):
         rv.append(date)
         date += step
     return rv
+
+
+def to_ns(durs):
+    """Gets durations (Timedeltas or ns) as float64 ns (NaT is NaN)"""
+    import datetime
+    import numpy as np
+    import pandas as pd
+    if isinstance(durs, (str, datetime.timedelta, np.timedelta64)):
+        return float(pd.Timedelta(durs).value)
+    if np.isscalar(durs):
+        return float(durs)
+    durs = pd.Series(durs) if not isinstance(durs, pd.Series) else durs
+    if durs.dtype.kind != 'm':
+        return durs.to_numpy('float64')
+    rv = durs.to_numpy().view('int64').astype('float64')
+    rv[durs.isna().to_numpy()] = np.nan
+    return rv
+
+
+def ns_to_timedelta(ns):
+    """Converts (float) ns durations to timedeltas, truncating fractional ns (NaN is NaT).
+    A scalar gets a Timedelta (or NaT)."""
+    import numpy as np
+    import pandas as pd
+    if np.ndim(ns) == 0:
+        ns = float(ns)
+        return pd.NaT if np.isnan(ns) else pd.Timedelta(int(ns), unit='ns')
+    ns = np.asarray(ns, dtype='float64')
+    is_nan = np.isnan(ns)
+    i8 = np.zeros(len(ns), dtype='int64')
+    i8[~is_nan] = ns[~is_nan]
+    i8[is_nan] = np.iinfo('int64').min
+    return pd.to_timedelta(i8.view('timedelta64[ns]'))
@@ -37,5 +37,51 @@ class Polygon:
         rv = 0
         for l in self.legs:
             rv += l.n_contracts()
-        return rv       
+        return rv
 
+
+class PolygonMetadata:
+    """Per symbol attributes of polygons (n_legs, n_contracts, has_future and leg_qtys),
+    parsed once per distinct symbol and cached (process-wide), so they can be gathered
+    for many rows by the symbols' categorical codes"""
+
+    columns = ['n_legs', 'n_contracts', 'has_future', 'leg_qtys']
+
+    __cache = {}
+
+    @staticmethod
+    def __parse(symbol):
+        poly = Polygon(symbol)
+        return (
+            poly.n_legs(), poly.n_contracts(), poly.has_future(),
+            tuple(l.leg_qty for l in poly.legs))
+
+    @staticmethod
+    def get(symbols):
+        """Gets the metadata of the (distinct) symbols, indexed by symbol"""
+        import pandas as pd
+        cache = PolygonMetadata.__cache
+        for s in symbols:
+            if s not in cache:
+                cache[s] = PolygonMetadata.__parse(s)
+        rv = pd.DataFrame(
+            [cache[s] for s in symbols],
+            index=pd.Index(symbols, name='symbol'),
+            columns=PolygonMetadata.columns)
+        return rv.astype({'n_legs': 'int64', 'n_contracts': 'int64', 'has_future': 'bool'})
+
+    @staticmethod
+    def take(symbols):
+        """Gets the metadata of each row's symbol (aligned with 'symbols', which may be a
+        categorical or a plain Series)"""
+        import numpy as np
+        import pandas as pd
+        cat = pd.Categorical(symbols)
+        meta = PolygonMetadata.get(list(cat.categories))
+        codes = cat.codes
+        if (codes < 0).any():
+            raise ValueError('Polygon metadata of missing (NaN) symbols')
+        rv = meta.iloc[codes]
+        rv.index = symbols.index if isinstance(symbols, pd.Series) else np.arange(
+            len(codes))
+        return rv
@@ -0,0 +1,26 @@
+import os
+import os.path
+
+
+def write_atomic(path, write_fn):
+    """Writes a file via write_fn(tmp_path), then moves it into place, so readers (and a
+    crashed writer) never leave a partially written file at 'path'"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path, obj):
+    import json
+
+    def write_json(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+    write_atomic(path, write_json)
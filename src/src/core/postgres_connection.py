@@ -1,4 +1,17 @@
+import threading
+
+
 class PostgresConnection:
+    """Connection parameters of a postgres database.  Engines are shared process-wide (one
+    per DSN and engine options), so callers reuse a single connection pool rather than
+    paying for connection setup each time."""
+
+    pool_size = 5
+    max_overflow = 10
+
+    __engines = {}
+    __engines_lock = threading.Lock()
+
     def __init__(
             self,
             host,
@@ -12,9 +25,44 @@ class PostgresConnection:
         self.password = password
         self.dbname = dbname
 
-    def connect(self):
+    @staticmethod
+    def __get_engine(key, create_fn):
+        with PostgresConnection.__engines_lock:
+            engine = PostgresConnection.__engines.get(key)
+            if engine is None:
+                engine = create_fn()
+                PostgresConnection.__engines[key] = engine
+            return engine
+
+    def __engine_kwargs(self, kwargs):
+        return {
+            'pool_size': PostgresConnection.pool_size,
+            'max_overflow': PostgresConnection.max_overflow,
+            'pool_pre_ping': True,
+            **kwargs
+        }
+
+    def connect(self, **kwargs):
+        """Gets the (shared) engine of the DSN.  kwargs are passed to create_engine (and
+        engines with different kwargs aren't shared)."""
         from sqlalchemy import create_engine
-        return create_engine(self.__str__())
+        engine_kwargs = self.__engine_kwargs(kwargs)
+        # (repr, as engine kwargs may be unhashable, e.g., connect_args)
+        key = (str(self), repr(sorted(engine_kwargs.items())))
+        return PostgresConnection.__get_engine(
+            key, lambda: create_engine(str(self), **engine_kwargs))
+
+    @staticmethod
+    def dispose_all():
+        """Closes the pooled connections of all the shared engines"""
+        with PostgresConnection.__engines_lock:
+            engines = list(PostgresConnection.__engines.values())
+            PostgresConnection.__engines.clear()
+        for engine in engines:
+            engine.dispose()
+
+    def dsn(self, driver='postgresql'):
+        return f'{driver}://{self.username}:{self.password}@{self.host}:{self.port}/{self.dbname}'
 
     def __str__(self):
-        return f'postgresql://{self.username}:{self.password}@{self.host}:{self.port}/{self.dbname}'
+        return self.dsn()
@@ -0,0 +1,95 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArrays:
+    """Named numpy arrays published in shared memory.  Pickling an instance only
+    sends the block names/dtypes/shapes, so worker processes attach to the arrays
+    instead of receiving copies of them.  The publishing process owns the blocks,
+    and unlinks them on close (or on exiting the 'with' block)."""
+
+    def __init__(self, layout, is_owner=False):
+        self.__layout = dict(layout)
+        self.__is_owner = is_owner
+        self.__blocks = {}
+        self.__arrays = {}
+        for name, (block_name, dtype, shape) in layout.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            self.__blocks[name] = block
+            self.__arrays[name] = np.ndarray(
+                shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    @staticmethod
+    def __create_block(dtype, shape):
+        # zero-sized blocks aren't permitted
+        nbytes = int(np.prod(shape, dtype='int64')) * np.dtype(dtype).itemsize
+        return shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+
+    @staticmethod
+    def allocate(specs: dict):
+        """Creates new (uninitialized) shared memory blocks of the arrays ({name: (dtype,
+        shape)}), to be filled in place, e.g., when the arrays are built piecewise"""
+        rv = SharedArrays({}, is_owner=True)
+        try:
+            for name, (dtype, shape) in specs.items():
+                rv.__add_block(name, dtype, shape)
+        except Exception:
+            rv.close()
+            raise
+        return rv
+
+    @staticmethod
+    def publish(arrays: dict):
+        """Copies the arrays into new shared memory blocks"""
+        rv = SharedArrays({}, is_owner=True)
+        try:
+            for name, a in arrays.items():
+                rv.add(name, a)
+        except Exception:
+            rv.close()
+            raise
+        return rv
+
+    def __add_block(self, name, dtype, shape):
+        dtype = np.dtype(dtype)
+        block = SharedArrays.__create_block(dtype, shape)
+        self.__blocks[name] = block
+        self.__arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        self.__layout[name] = (block.name, dtype.str, tuple(shape))
+        return self.__arrays[name]
+
+    def add(self, name, a):
+        """Copies the array into a new shared memory block (of the publishing process)"""
+        if not self.__is_owner:
+            raise ValueError('Arrays can only be added by the publishing process')
+        a = np.ascontiguousarray(a)
+        self.__add_block(name, a.dtype, a.shape)[...] = a
+
+    def __getitem__(self, name):
+        return self.__arrays[name]
+
+    def __contains__(self, name):
+        return name in self.__arrays
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.__arrays.values())
+
+    def __getstate__(self):
+        return self.__layout
+
+    def __setstate__(self, layout):
+        self.__init__(layout)
+
+    def close(self):
+        self.__arrays = {}
+        for block in self.__blocks.values():
+            block.close()
+            if self.__is_owner:
+                block.unlink()
+        self.__blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_typ, ex_val, tb):
+        self.close()
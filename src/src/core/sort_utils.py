@@ -12,3 +12,79 @@ def get_within_bounds(value, lo=None, hi=None):
 def binary_search(items, value, within_bounds=False):
     idx = bisect_left(items, value)
     return get_within_bounds(idx, 0, len(items) - 1) if within_bounds else idx
+
+
+class SortedGroups:
+    """The values of each group (e.g., the durations of each symbol's opps), sorted once
+    within the groups, from which counts and quantiles of every group are read with
+    array ops.  NaN values are excluded.  Groups are identified by codes in
+    [0, n_groups)."""
+
+    def __init__(self, codes, values, n_groups=None):
+        import numpy as np
+        codes = np.asarray(codes, dtype='int64')
+        values = np.asarray(values, dtype='float64')
+        self.n_groups = int(codes.max()) + 1 if n_groups is None and len(
+            codes) else (n_groups or 0)
+        is_valid = ~np.isnan(values)
+        codes = codes[is_valid]
+        values = values[is_valid]
+        order = np.lexsort((values, codes))
+        self.codes = codes[order]
+        self.values = values[order]
+        group_ids = np.arange(self.n_groups)
+        self.starts = np.searchsorted(self.codes, group_ids, side='left')
+        self.ends = np.searchsorted(self.codes, group_ids, side='right')
+        # (code, value rank) keys, so each group's values can be searched at once
+        self.__uniques, ranks = np.unique(self.values, return_inverse=True)
+        self.__keys = self.codes * (len(self.__uniques) + 1) + ranks
+
+    def counts(self):
+        return self.ends - self.starts
+
+    def count_gt(self, thresh):
+        """Gets the number of values > thresh in each group"""
+        import numpy as np
+        n_le = np.searchsorted(self.__uniques, thresh, side='right')
+        first_gt = np.searchsorted(
+            self.__keys,
+            np.arange(self.n_groups) * (len(self.__uniques) + 1) + n_le,
+            side='left')
+        return self.ends - first_gt
+
+    def count_ge(self, thresh):
+        """Gets the number of values >= thresh in each group"""
+        import numpy as np
+        n_lt = np.searchsorted(self.__uniques, thresh, side='left')
+        first_ge = np.searchsorted(
+            self.__keys,
+            np.arange(self.n_groups) * (len(self.__uniques) + 1) + n_lt,
+            side='left')
+        return self.ends - first_ge
+
+    def quantile(self, q):
+        """Gets the q quantile of each group (NaN if empty), linearly interpolated between
+        the closest ranks (as pandas/numpy do by default)"""
+        import numpy as np
+        n = self.counts()
+        rv = np.full(self.n_groups, np.nan)
+        is_nonempty = n > 0
+        if not is_nonempty.any():
+            return rv
+        n = n[is_nonempty]
+        starts = self.starts[is_nonempty]
+        # (pandas passes percentiles to numpy, so the q -> % -> q round trip is kept)
+        q = (q * 100.0) / 100
+        virtual = (n - 1) * q
+        prev = np.floor(virtual)
+        gamma = virtual - prev
+        prev = np.minimum(prev.astype('int64'), n - 1)
+        next = np.minimum(prev + 1, n - 1)
+        a = self.values[starts + prev]
+        b = self.values[starts + next]
+        diff_b_a = b - a
+        res = a + diff_b_a * gamma
+        is_upper = gamma >= 0.5
+        res[is_upper] = b[is_upper] - diff_b_a[is_upper] * (1 - gamma[is_upper])
+        rv[is_nonempty] = res
+        return rv
@@ -0,0 +1,117 @@
+from src.core.logger import Logger
+from src.core.file_utils import write_atomic, write_json_atomic
+from src.pcap_location_params import PCapLocationParams
+
+from glob import glob
+import hashlib
+import json
+import os.path
+import pandas as pd
+
+
+def hash_opp_source(date_opp: pd.DataFrame, opp_source=None):
+    """Hashes the (market_date, symbol, opp_start_eid) keys of a date's opps, along with an
+    optional identifier of their source (e.g., the opp table/key)"""
+    h = hashlib.sha1(str(opp_source).encode())
+    h.update(
+        pd.util.hash_pandas_object(
+            date_opp.index.unique(), index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def hash_synth_book_source(date_sb: pd.DataFrame):
+    """Hashes the columns (and dtypes) and the (market_date, symbol, eid) keys of a date's
+    synth book, so partitions merged from a differently loaded synth book (e.g., another
+    schema, column projection or tod/eid range) aren't reused"""
+    h = hashlib.sha1(
+        '|'.join(f'{c}:{t}' for c, t in date_sb.dtypes.items()).encode())
+    h.update(
+        pd.util.hash_pandas_object(date_sb.index, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+class MergedOppBookCache:
+    """Feather partitions (one per date) of SyntheticBookMerger output, stored in each date's
+    feather cache directory.  Partitions are keyed by channel, date, delay,
+    show_all_changes and a hash of the opps, and are invalidated when any of the date's
+    synthetic_book_{pid} or event_info feather files are modified.  Partitions are also
+    keyed by a hash of the synth book (see hash_synth_book_source), as they contain its
+    columns."""
+
+    index_cols = ['market_date', 'symbol', 'opp_start_eid', 'synth_bk_eid']
+
+    def __init__(self, channel, pids=None, store_root=None, log_level=1):
+        self.__channel = channel
+        self.__pids = pids
+        self.__pcap = PCapLocationParams(channel, store_root=store_root)
+        self.__logger = Logger(log_level)
+
+    def __dir_path(self, date):
+        return os.path.join(
+            self.__pcap.feather_cache_path(
+                date=PCapLocationParams.fmt_date(date)), 'merged_opp_book')
+
+    def __upstream_files(self, date):
+        date = PCapLocationParams.fmt_date(date)
+        if self.__pids is None:
+            files = glob(
+                self.__pcap.feather_file_path(
+                    name='synthetic_book_*', date=date))
+        else:
+            files = [
+                self.__pcap.feather_file_path(
+                    name=f'synthetic_book_{pid}', date=date)
+                for pid in self.__pids
+            ]
+        files.append(self.__pcap.feather_file_path(name='event_info', date=date))
+        return sorted(files)
+
+    def __upstream_mtimes(self, date):
+        return {
+            os.path.basename(f): os.path.getmtime(f)
+            for f in self.__upstream_files(date) if os.path.isfile(f)
+        }
+
+    def key(self, date, delay, show_all_changes, opp_hash, sb_hash):
+        parts = [
+            self.__channel,
+            PCapLocationParams.fmt_date(date),
+            pd.Timedelta(delay).value, bool(show_all_changes), opp_hash, sb_hash
+        ]
+        return hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+
+    def partition_path(self, date, key):
+        return os.path.join(self.__dir_path(date), f'{key}.feather')
+
+    def manifest_path(self, date, key):
+        return os.path.join(self.__dir_path(date), f'{key}.json')
+
+    def read(self, date, delay, show_all_changes, opp_hash, sb_hash):
+        """Gets the cached merged opp book for the date (None if missing or stale)"""
+        key = self.key(date, delay, show_all_changes, opp_hash, sb_hash)
+        path = self.partition_path(date, key)
+        manifest_path = self.manifest_path(date, key)
+        if not (os.path.isfile(path) and os.path.isfile(manifest_path)):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('upstream_mtimes') != self.__upstream_mtimes(date):
+            self.__logger.log(f'[{date}] Merged opp book cache is stale', 1)
+            return None
+        return pd.read_feather(path).set_index(MergedOppBookCache.index_cols)
+
+    def write(self, date, df, delay, show_all_changes, opp_hash, sb_hash):
+        key = self.key(date, delay, show_all_changes, opp_hash, sb_hash)
+        # (the partition is replaced before its manifest, and each is replaced whole, so a
+        # crashed write never pairs a manifest with a partial partition)
+        write_atomic(self.partition_path(date, key), df.reset_index().to_feather)
+        write_json_atomic(
+            self.manifest_path(date, key), {
+                'channel': self.__channel,
+                'date': PCapLocationParams.fmt_date(date),
+                'delay_ns': pd.Timedelta(delay).value,
+                'show_all_changes': bool(show_all_changes),
+                'opp_hash': opp_hash,
+                'sb_hash': sb_hash,
+                'upstream_mtimes': self.__upstream_mtimes(date)
+            })
@@ -1,59 +1,217 @@
 import os
-from src.core.domain.polygon import Polygon
+from src.core.file_utils import write_atomic
+from src.core.logger import Logger
+from src.core.domain.polygon import PolygonMetadata
+from src.core.sort_utils import SortedGroups
+from src.core.date_utils import to_ns, ns_to_timedelta
+
+
+def duration_cols():
+    return ['start_t_time', 'fs_win', 'ls_win']
 
 
 def cast_opp_summary_columns(opps):
+    """Casts the columns of an opp summary (in place).  Durations are kept as (int64) ns,
+    see date_utils.ns_to_timedelta for display."""
     import pandas as pd
     opps['date'] = pd.to_datetime(opps['date'])
     opps.rename(columns={"prod": "asset"}, inplace=True)
     opps.drop(columns='start_h_t_time', inplace=True)
-    opps['start_t_time'] = pd.to_timedelta(opps['start_t_time'], unit='ns')
-    opps['fs_win'] = pd.to_timedelta(opps['fs_win'], unit='ns')
-    opps['ls_win'] = pd.to_timedelta(opps['ls_win'], unit='ns')
+    for c in duration_cols():
+        # (e.g., a summary previously cast to timedeltas)
+        if opps[c].dtype.kind == 'm':
+            opps[c] = to_ns(opps[c])
 
 
 def compute_pnl(summ_rows_arg, fee_per_contract, latency, latency_col):
-    def compute_pnl_row(r):
-        n_contracts = Polygon(r['symbol']).n_contracts()
-        n_legs = Polygon(r['symbol']).n_legs()
-        # piggy backing filtering rows out
-        if (r['merged_qty'] == 1):
-            if (r[latency_col] < 1000000):
-                return -1.0
-        if r[latency_col] < latency:
-            return -1.0
-        if (r['is_direct'] == False):
-            if (r['merged_qty'] < n_legs):
-                return -1.0
-        n_contracts = Polygon(r['symbol']).n_contracts()
-        pnl = r['merged_value'] - n_contracts * fee_per_contract
-        pnl = pnl * r['merged_qty']
-        return pnl
-
-    def agg(grp_rows):
-        m_idx = grp_rows['pnl'].argmax()
-        r = grp_rows.iloc[m_idx]
-        return r
-
-    summ_rows = summ_rows_arg.copy()
-    summ_rows['pnl'] = summ_rows.apply(lambda r: compute_pnl_row(r), axis=1)
-    summ_rows = summ_rows[summ_rows['pnl'] > 0]
-    summ_rows['key'] = summ_rows['date'] + '-' + summ_rows['opp_id'].astype(
-        str)
-    return summ_rows.groupby('key').apply(lambda x: agg(x))
-    # return summ_rows
-
-
-def map_opp_summary_csvs(months):
+    """Computes the pnl of each row (net of fees, per contract), and selects the best row
+    of each (date, opp_id).  Rows are evaluated with vectorized masks, and the polygon
+    attributes are gathered (by symbol) from the PolygonMetadata cache."""
+    import numpy as np
+
+    meta = PolygonMetadata.take(summ_rows_arg['symbol'])
+    merged_qty = summ_rows_arg['merged_qty'].to_numpy()
+    lat = summ_rows_arg[latency_col].to_numpy()
+    # piggy backing filtering rows out
+    is_filtered = ((merged_qty == 1) & (lat < 1000000)) | (lat < latency)
+    is_filtered |= (summ_rows_arg['is_direct'] == False).to_numpy() & (
+        merged_qty < meta['n_legs'].to_numpy())
+    pnl = summ_rows_arg['merged_value'].to_numpy() - meta['n_contracts'].to_numpy(
+    ) * fee_per_contract
+    pnl = np.where(is_filtered, -1.0, pnl * merged_qty).astype('float64')
+
+    summ_rows = summ_rows_arg.assign(pnl=pnl).take(np.flatnonzero(pnl > 0))
+    keys = get_opp_keys(summ_rows)
+    best = _segmented_argmax(keys, summ_rows['pnl'].to_numpy())
+    summ_rows = summ_rows.take(best).assign(key=keys[best])
+    return summ_rows.set_index(summ_rows['key'])
+
+
+def get_opp_keys(summ_rows):
+    """Gets the int64 key of each row's opp: the date's ordinal (days since the epoch) in
+    the upper 32 bits, and the opp_id in the lower 32"""
+    import numpy as np
+    import pandas as pd
+
+    days = pd.to_datetime(summ_rows['date']).to_numpy().astype(
+        'datetime64[D]').astype('int64')
+    opp_id = summ_rows['opp_id'].to_numpy().astype('int64')
+    if len(opp_id) and (opp_id.min() < 0 or opp_id.max() >= 1 << 32):
+        raise ValueError('opp_ids must be in [0, 2^32) to be packed into opp keys')
+    return (days << 32) | opp_id
+
+
+def _segmented_argmax(keys, values):
+    """Gets the position of the (first) max value of each key, ordered by key.  Rows are
+    sorted by (key, -value), which is stable, so each key's first row is its argmax."""
+    import numpy as np
+
+    order = np.lexsort((-values, keys))
+    sorted_keys = keys[order]
+    return order[np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]] if len(
+        order) else order
+
+
+def _get_pnl_sweep_arrays(summ_rows, latency_col):
+    """Gets the arrays of the pnl sweep, ordered by opp (date, opp_id), along with the
+    start of each opp's rows"""
+    import numpy as np
+
+    meta = PolygonMetadata.take(summ_rows['symbol'])
+    keys = get_opp_keys(summ_rows)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    merged_qty = summ_rows['merged_qty'].to_numpy()[order]
+    lat = summ_rows[latency_col].to_numpy()[order]
+    is_filtered = (merged_qty == 1) & (lat < 1000000)
+    is_filtered |= (summ_rows['is_direct'] == False).to_numpy()[order] & (
+        merged_qty < meta['n_legs'].to_numpy()[order])
+    return {
+        'merged_value': summ_rows['merged_value'].to_numpy('float64')[order],
+        'merged_qty': merged_qty,
+        'n_contracts': meta['n_contracts'].to_numpy()[order],
+        'lat': lat,
+        'is_filtered': is_filtered,
+        'opp_starts': np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(
+            keys) else np.zeros(0, dtype='int64')
+    }
+
+
+def _sweep_pnl(arrays, fees_per_contract, latencies):
+    """Gets the (fee_per_contract, latency, n_opps, pnl) of each combination.  The pnls of
+    all the fees (of a latency) are computed at once (n_fees x n_rows), and each opp's best
+    row is its segment's max (rows are ordered by opp)."""
+    import numpy as np
+
+    fees = np.asarray(fees_per_contract, dtype='float64')
+    opp_starts = arrays['opp_starts']
+    rv = []
+    for latency in latencies:
+        if not len(opp_starts):
+            rv.extend((f, latency, 0, 0.0) for f in fees)
+            continue
+        is_valid = ~(arrays['is_filtered'] | (arrays['lat'] < latency))
+        pnl = (arrays['merged_value'] - fees[:, None] * arrays['n_contracts']
+               ) * arrays['merged_qty']
+        pnl = np.where(is_valid, pnl, -1.0)
+        opp_pnl = np.maximum.reduceat(pnl, opp_starts, axis=1)
+        is_opp = opp_pnl > 0
+        rv.extend(
+            zip(
+                fees, [latency] * len(fees), is_opp.sum(axis=1),
+                np.where(is_opp, opp_pnl, 0.0).sum(axis=1)))
+    return rv
+
+
+def _sweep_shared_pnl(args):
+    shared, fees_per_contract, latencies = args
+    try:
+        return _sweep_pnl(shared, fees_per_contract, latencies)
+    finally:
+        shared.close()
+
+
+def compute_pnl_sweep(
+        summ_rows, fees_per_contract, latencies, latency_col, n_procs=None):
+    """Computes the total pnl (and number of opps) of each fee_per_contract x latency
+    combination, selecting the best row of each (date, opp_id) as in compute_pnl, in a
+    single pass over the rows per latency.  The latencies are split across 'n_procs'
+    processes (if > 1), which share the rows' arrays.  Returns a tidy frame with columns
+    fee_per_contract, latency, n_opps and pnl."""
+    import numpy as np
     import pandas as pd
-    opps = {}
-    for month in months:
-        poly_vals = pd.read_csv(f'data/360/poly_vals_summ_{month}.csv')
-        cast_opp_summary_columns(poly_vals)
-        opps[month] = poly_vals
+    from multiprocessing import Pool
+    from src.core.shared_arrays import SharedArrays
+
+    latencies = list(latencies)
+    arrays = _get_pnl_sweep_arrays(summ_rows, latency_col)
+    if n_procs is None or n_procs <= 1 or len(latencies) <= 1:
+        rows = _sweep_pnl(arrays, fees_per_contract, latencies)
+    else:
+        n_procs = min(n_procs, len(latencies))
+        with SharedArrays.publish(arrays) as shared:
+            with Pool(n_procs) as p:
+                results = p.map(
+                    _sweep_shared_pnl, [
+                        (shared, fees_per_contract, list(lats))
+                        for lats in np.array_split(
+                            np.asarray(latencies, dtype=object), n_procs)
+                    ])
+        rows = [r for res in results for r in res]
+    return pd.DataFrame.from_records(
+        rows, columns=['fee_per_contract', 'latency', 'n_opps', 'pnl'])
+
+
+def read_opp_summary_csv(path, log_level=1):
+    """Reads an opp summary CSV with pyarrow's (multithreaded) reader, falling back to
+    pandas' reader if pyarrow can't parse it"""
+    import pandas as pd
+    try:
+        return pd.read_csv(path, engine='pyarrow')
+    except Exception as e:
+        Logger(log_level).log(
+            f'Unable to read {path} with pyarrow ({e}), falling back to pandas', 2)
+        return pd.read_csv(path)
+
+
+def load_opp_summary(csv_path, use_sidecar=True, log_level=1):
+    """Loads (and casts) an opp summary CSV.  The casted summary (categorical
+    symbol/asset, ns durations) is cached in a feather sidecar (next to the CSV), which
+    is used instead of the CSV while it's newer than the CSV."""
+    import pandas as pd
+    sidecar_path = os.path.splitext(csv_path)[0] + '.feather'
+    if use_sidecar and os.path.isfile(sidecar_path) and (
+            not os.path.isfile(csv_path)
+            or os.path.getmtime(sidecar_path) >= os.path.getmtime(csv_path)):
+        return pd.read_feather(sidecar_path)
+    opps = read_opp_summary_csv(csv_path, log_level=log_level)
+    cast_opp_summary_columns(opps)
+    for c in ['symbol', 'asset']:
+        if c in opps:
+            opps[c] = opps[c].astype('category')
+    if use_sidecar:
+        try:
+            write_atomic(sidecar_path, opps.to_feather)
+        except Exception as e:
+            Logger(log_level).log(f'Unable to write {sidecar_path}: {e}', 2)
     return opps
 
 
+def map_opp_summary_csvs(
+        months, data_dir='data/360', use_sidecar=True, n_threads=None, log_level=1):
+    """Loads the opp summaries of the months (in parallel threads), see load_opp_summary"""
+    from multiprocessing.pool import ThreadPool
+    months = list(months)
+    if not months:
+        return {}
+    paths = [f'{data_dir}/poly_vals_summ_{month}.csv' for month in months]
+    with ThreadPool(min(n_threads or len(months), len(months))) as pool:
+        results = pool.map(
+            lambda path: load_opp_summary(
+                path, use_sidecar=use_sidecar, log_level=log_level), paths)
+    return dict(zip(months, results))
+
+
 class DurationSummarizer:
     @staticmethod
     def val_gt_col(val):
@@ -81,69 +239,56 @@ class DurationSummarizer:
             quantiles = DurationSummarizer.default_quantiles()
         return list(map(DurationSummarizer.get_quantile_col, quantiles))
 
+    @staticmethod
+    def summarize_symbol_durations(
+            symbols, merged_value, ls_win_ns, value_threshes, quantiles):
+        """Gets the number of opps, the number of opps per value threshold, and the
+        ls_win quantiles of each symbol.  Values and durations are each sorted once
+        within the symbols (see SortedGroups), and the counts/quantiles of every symbol
+        are read from the sorted arrays.  Quantiles are only converted to Timedeltas
+        once computed (on ns)."""
+        import numpy as np
+        import pandas as pd
+
+        codes, symbols = pd.factorize(symbols, sort=True)
+        n_symbols = len(symbols)
+        durs = SortedGroups(codes, ls_win_ns, n_symbols)
+        values = SortedGroups(codes, merged_value, n_symbols)
+
+        data = {'n_opps': np.bincount(codes, minlength=n_symbols)}
+        for vt in value_threshes:
+            data[f'n_opps_v{vt}'] = values.count_ge(vt)
+        for q in quantiles:
+            data[f'{q:.2f}'] = ns_to_timedelta(durs.quantile(q))
+        return pd.DataFrame(
+            data=data,
+            index=pd.Index(np.asarray(symbols), name='symbol'))
+
     @staticmethod
     def get_durations_per_polygon(
             opps, min_value=10, min_qty=1, min_duration=None, quantiles=None):
         import numpy as np
-        import pandas as pd
 
         if quantiles == None:
             quantiles = DurationSummarizer.default_quantiles()
         value_threshes = range(10, 50, 10)
-        time_threshes = [
-            np.timedelta64(v, 'us') for v in range(100000, 200000, 25000)
-        ]
-        refactored_opps = {}
-        # time_threshes = [np.timedelta64(v, 'us') for v in range(50, 200, 25)]
+        result = {}
         for month in opps:
             mo = opps[month]
+            merged_value = mo['merged_value'].to_numpy('float64')
+            ls_win = to_ns(mo['ls_win'])
+            mask = np.ones(len(mo), dtype=bool)
             if min_value != None:
-                mo = mo.loc[(mo['merged_value'] >= min_value)]
+                mask &= merged_value >= min_value
             if min_qty != None:
-                mo = mo.loc[(mo['merged_qty'] >= min_qty)]
+                mask &= mo['merged_qty'].to_numpy() >= min_qty
             if min_duration != None:
-                mo = mo.loc[(mo['ls_win'] >= min_duration)]
-            mo = mo.rename(columns={'ls_win': 'ls_win_temp'})
-            mo['ls_win'] = mo['ls_win_temp'].apply(
-                lambda x: pd.Timedelta(0, unit='us')
-                if x < pd.Timedelta(0, unit='us') else x)
-            mo = mo.drop(columns=['ls_win_temp'])
-            for vt in value_threshes:
-                mo[DurationSummarizer.val_gt_col(vt)] = mo['merged_value'] > vt
-            for tt in time_threshes:
-                mo[DurationSummarizer.dur_gt_col(tt)] = mo['ls_win'] > tt
-            refactored_opps[month] = mo
-        bin_breakdowns = {}
-        for vt in value_threshes:
-            data = {'n_total': [len(mo) for mo in refactored_opps.values()]}
-            # data[val_dur_col(vt, tt)] = [len(mo.loc[mo[dur_gt_col(tt)] & mo[val_gt_col(vt)]]) for mo in opps.values()]
-            for q in reversed([i * 0.1 for i in range(1, 10)]):
-                data[f'{1 - q:.1f}'] = [
-                    mo.loc[mo[DurationSummarizer.val_gt_col(vt)]]
-                    ['ls_win'].quantile(q)
-                    # f"{mo.loc[mo[DurationSummarizer.val_gt_col(vt)]]['ls_win'].apply(lambda x: x.microseconds).quantile(q):,.1f}"
-                    for mo in refactored_opps.values()
-                ]
-            bin_breakdown = pd.DataFrame(
-                index=refactored_opps.keys(), data=data)
-            bin_breakdowns[vt] = bin_breakdown
-
-        # quantiles = [.125 * i for i in range(1, int(1.0/.125 - 1))] + [.95, .99]
-        result = {}
-        for month, month_opps in refactored_opps.items():
-            # nov_opps = opps['nov']
-            month_opps_syms = month_opps.groupby('symbol')
-
-            def count_opps(sym_opps):
-                data = {'n_opps': len(sym_opps)}
-                for vt in value_threshes:
-                    data[f'n_opps_v{vt}'] = len(
-                        sym_opps.loc[sym_opps['merged_value'] >= vt])
-                for q in quantiles:
-                    data[f'{q:.2f}'] = sym_opps['ls_win'].quantile(q)
-                return pd.Series(data)
-
-            sym_opp_grps = pd.DataFrame(data=month_opps_syms.apply(count_opps))
+                mask &= ls_win >= to_ns(min_duration)
+            # negative durations are clamped to 0
+            ls_win = np.maximum(ls_win[mask], 0)
+            sym_opp_grps = DurationSummarizer.summarize_symbol_durations(
+                mo['symbol'].to_numpy()[mask], merged_value[mask], ls_win,
+                value_threshes, quantiles)
             sym_opp_grps.sort_values('n_opps', ascending=False, inplace=True)
             result[month] = sym_opp_grps
         return result
@@ -0,0 +1,98 @@
+from src.core.logger import Logger
+from src.core.file_utils import write_atomic, write_json_atomic
+
+from multiprocessing.pool import ThreadPool
+import json
+import os
+import os.path
+import pandas as pd
+
+
+def read_sql_concurrently(conn, queries, n_threads=None):
+    """Runs the queries ({name: query}) concurrently on a thread pool, and gets the
+    resulting {name: DataFrame}.  'conn' should be a pooled engine (see
+    PostgresConnection.connect), so each thread checks out its own connection."""
+    if not queries:
+        return {}
+    n_threads = n_threads or len(queries)
+    with ThreadPool(min(n_threads, len(queries))) as pool:
+        results = pool.map(lambda q: pd.read_sql(q, conn), list(queries.values()))
+    return dict(zip(queries.keys(), results))
+
+
+def read_reference_data(conn_fn, queries, name, ttl='1d', store_root=None, log_level=1):
+    """Reads the reference tables ({name: query}) concurrently, through a
+    ReferenceDataSnapshot unless 'ttl' is None"""
+    if ttl is None:
+        return read_sql_concurrently(conn_fn(), queries)
+    return ReferenceDataSnapshot(
+        name, ttl=ttl, store_root=store_root,
+        log_level=log_level).load(conn_fn, queries)
+
+
+class ReferenceDataSnapshot:
+    """An on-disk (feather) snapshot of (rarely changing) reference tables, e.g.,
+    synthetic_security and its fees.  Tables are re-read (concurrently) once the snapshot
+    is older than the TTL; if that read fails (e.g., offline), the stale snapshot is used
+    instead."""
+
+    def __init__(self, name, ttl='1d', store_root=None, log_level=1):
+        store_root = store_root if store_root is not None else '~/spartan_store/reference_data'
+        self.__dir_path = os.path.join(os.path.expanduser(store_root), name)
+        self.__ttl = pd.Timedelta(ttl)
+        self.__logger = Logger(log_level)
+
+    def table_path(self, table):
+        return os.path.join(self.__dir_path, f'{table}.feather')
+
+    def manifest_path(self):
+        return os.path.join(self.__dir_path, 'manifest.json')
+
+    def __read_manifest(self):
+        if not os.path.isfile(self.manifest_path()):
+            return {}
+        with open(self.manifest_path()) as f:
+            return json.load(f)
+
+    def age(self, tables):
+        """Gets the age of the snapshot's tables (None if any are missing)"""
+        manifest = self.__read_manifest()
+        if any(
+                t not in manifest or not os.path.isfile(self.table_path(t))
+                for t in tables):
+            return None
+        oldest = min(pd.Timestamp(manifest[t]) for t in tables)
+        return pd.Timestamp.now() - oldest
+
+    def __read(self, tables):
+        return {t: pd.read_feather(self.table_path(t)) for t in tables}
+
+    def __write(self, dfs):
+        manifest = self.__read_manifest()
+        for t, df in dfs.items():
+            try:
+                write_atomic(self.table_path(t), df.reset_index(drop=True).to_feather)
+            except Exception as e:
+                self.__logger.log(f'Unable to snapshot \'{t}\': {e}', 2)
+                continue
+            manifest[t] = pd.Timestamp.now().isoformat()
+        write_json_atomic(self.manifest_path(), manifest)
+
+    def load(self, conn_fn, queries, n_threads=None):
+        """Gets the {name: DataFrame} of the queries ({name: query}), from the snapshot if
+        it's within the TTL, otherwise from the db (conn_fn gets the engine, so it isn't
+        even created if the snapshot is fresh)."""
+        age = self.age(queries.keys())
+        if age is not None and age <= self.__ttl:
+            return self.__read(queries.keys())
+        try:
+            dfs = read_sql_concurrently(conn_fn(), queries, n_threads)
+        except Exception as e:
+            if age is None:
+                raise
+            self.__logger.log(
+                f'Unable to refresh the {list(queries)} snapshot (using the {age} old snapshot): {e}',
+                2)
+            return self.__read(queries.keys())
+        self.__write(dfs)
+        return dfs
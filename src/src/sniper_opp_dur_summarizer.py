@@ -1,7 +1,16 @@
+import numpy as np
 import pandas as pd
 import src.core.kwarg_picker as kwarg_picker
-from src.core.iter_utils import ensure_iterable
+from src.core.iter_utils import ensure_iterable, is_none_or_empty
+from src.core.logger import Logger
+from src.core.file_utils import write_atomic
 from src.core.errors import UnexpectedTypeError
+from src.core.sort_utils import SortedGroups
+from src.core.date_utils import to_ns, ns_to_timedelta
+
+from glob import glob
+import os
+import os.path
 
 
 def fmt_quantile_col(q, prefix=None, suffix=None):
@@ -13,7 +22,37 @@ def fmt_quantile_col(q, prefix=None, suffix=None):
     return rv
 
 
+def _get_group_codes(opps):
+    """Gets the rows (frame), the group code of each row, and the keys of the groups (None
+    for a single frame)"""
+    if isinstance(opps, pd.DataFrame):
+        return opps, np.zeros(len(opps), dtype='int64'), None
+    if isinstance(opps, pd.core.groupby.DataFrameGroupBy):
+        # (rows with NaN keys are dropped from the groups, and ngroup gets NaN for them)
+        codes = opps.ngroup().fillna(-1).astype('int64').to_numpy()
+        keys = opps.grouper.result_index
+        if len(opps.grouper.groupings) == 1 and not opps.observed:
+            # (as apply does, the unobserved categories of a single grouping are kept)
+            return opps.obj, codes, keys
+        is_valid = codes >= 0
+        observed = np.unique(codes[is_valid])
+        remap = np.full(len(keys), -1, dtype='int64')
+        remap[observed] = np.arange(len(observed))
+        codes = np.where(is_valid, remap[np.maximum(codes, 0)], -1)
+        return opps.obj, codes, keys[observed]
+    raise UnexpectedTypeError(
+        name='opps',
+        actual=type(opps),
+        expected=[pd.DataFrame, pd.core.groupby.DataFrameGroupBy])
+
+
 def get_opp_dur_summary(opps, **kwargs):
+    """Gets the number of opps and either the duration quantiles or the number of
+    durations over each threshold ('threshes'), of a frame of opps or of each group of a
+    DataFrameGroupBy.  Each duration column is sorted once within the groups (see
+    SortedGroups), from which every group's counts and quantiles are read.  A group's
+    summary is a row of the (single, wide) result, indexed by the group's keys (and 0, as
+    in the per-group frames this used to concatenate)."""
     quantiles = ensure_iterable(
         kwarg_picker.pick(kwargs, 'quantiles', 'quantile')
         or [0.1 * i for i in range(1, 10)])
@@ -23,26 +62,308 @@ def get_opp_dur_summary(opps, **kwargs):
         kwarg_picker.pick(
             kwargs, 'threshes', 'thresh', 'thresholds', 'threshold'), None)
 
-    def thresh_impl(x):
-        thresh_df = pd.DataFrame(
-            data=dict([('n_opps', [len(x)])] + [(
-                f'{c}>={int(t.value / 1000)}us', [len(x.loc[x[c] > t])])
-                                                for t in threshes
-                                                for c in dur_cols]))
-        return thresh_df
+    df, codes, keys = _get_group_codes(opps)
+    is_grouped = codes >= 0
+    n_groups = 1 if keys is None else len(keys)
+    codes = codes[is_grouped]
+    sorted_durs = {
+        c: SortedGroups(codes, to_ns(df[c])[is_grouped], n_groups)
+        for c in dur_cols
+    }
+
+    data = {'n_opps': np.bincount(codes, minlength=n_groups)}
+    if threshes is None:
+        for q in quantiles:
+            for col in dur_cols:
+                res = sorted_durs[col].quantile(q)
+                if df[col].dtype.kind == 'm':
+                    res = ns_to_timedelta(res)
+                data[fmt_quantile_col(q, prefix=col)] = res
+    else:
+        for t in threshes:
+            for c in dur_cols:
+                data[f'{c}>={int(t.value / 1000)}us'] = sorted_durs[c].count_gt(
+                    to_ns(t))
+
+    if keys is None:
+        index = pd.RangeIndex(1)
+    else:
+        key_levels = [keys.get_level_values(i) for i in range(keys.nlevels)]
+        index = pd.MultiIndex.from_arrays(
+            key_levels + [np.zeros(n_groups, dtype='int64')],
+            names=list(keys.names) + [None])
+    return pd.DataFrame(data=data, index=index)
+
+
+# Duration sketches
+#
+# A sketch of a column of durations is a (relative-error, log-bucketed) histogram: a
+# duration x is counted in bucket ceil(log_gamma(|x|)), gamma = (1 + alpha) / (1 - alpha),
+# whose value 2 * gamma^k / (gamma + 1) is within 'alpha' (relative) of every duration in
+# it.  Sketches of the same alpha are merged by adding the counts of their buckets, so
+# they're built once per (market_date, symbol) and merged for any range of dates.  Buckets
+# are stored as signed keys (0 for |x| < 1ns, and +-(k + 1) otherwise), which sort in the
+# order of their durations.
+
+def _sketch_gamma(alpha):
+    if not 0 < alpha < 1:
+        raise ValueError(f'Expected 0 < alpha < 1 (got {alpha})')
+    return (1 + alpha) / (1 - alpha)
+
+
+def sketch_keys(ns, alpha):
+    """Gets the bucket key of each (non-NaN, float ns) duration"""
+    ns = np.asarray(ns, dtype='float64')
+    abs_ns = np.abs(ns)
+    is_nonzero = abs_ns >= 1
+    k = np.zeros(len(ns), dtype='int64')
+    k[is_nonzero] = np.ceil(
+        np.log(abs_ns[is_nonzero]) / np.log(_sketch_gamma(alpha))) + 1
+    return (np.sign(ns).astype('int64') * k).astype('int32')
 
-    def dur_impl(x):
+
+def sketch_key_values(keys, alpha):
+    """Gets the (float ns) duration of each bucket key"""
+    gamma = _sketch_gamma(alpha)
+    keys = np.asarray(keys, dtype='int64')
+    k = np.abs(keys) - 1
+    return np.where(
+        keys == 0, 0.0, np.sign(keys) * 2 * np.power(gamma, k) / (gamma + 1))
+
+
+def build_dur_sketches(opps: pd.DataFrame, alpha=0.01, **kwargs):
+    """Gets the duration sketches of each (market_date, symbol) of the opps (indexed, or
+    with columns, by market_date and symbol), as a frame of the bucket counts:
+
+        market_date, symbol, dur, key, count
+
+    sorted by (market_date, symbol, dur, key)"""
+    dur_cols = ensure_iterable(
+        kwarg_picker.pick_or(kwargs, ['lsn_win', 'fsn_win'], 'durs', 'dur'))
+    _sketch_gamma(alpha)
+
+    def get_level(name):
+        if name in opps.index.names:
+            return opps.index.get_level_values(name)
+        return pd.Index(opps[name])
+
+    market_date = pd.to_datetime(get_level('market_date'))
+    symbol = get_level('symbol').astype(str)
+    frames = []
+    for c in dur_cols:
+        ns = to_ns(opps[c])
+        is_valid = ~np.isnan(ns)
+        frames.append(
+            pd.DataFrame({
+                'market_date': market_date[is_valid],
+                'symbol': symbol[is_valid],
+                'dur': c,
+                'key': sketch_keys(ns[is_valid], alpha)
+            }))
+    if not frames:
         return pd.DataFrame(
-            data=dict([('n_opps', [len(x)])] +
-                      [(fmt_quantile_col(q, prefix=col), [x[col].quantile(q)])
-                       for q in quantiles for col in dur_cols]))
+            columns=['market_date', 'symbol', 'dur', 'key', 'count'])
+    return merge_dur_sketches(
+        pd.concat(frames, ignore_index=True).assign(count=1),
+        by=['market_date', 'symbol'])
 
-    impl = dur_impl if threshes is None else thresh_impl
-    if isinstance(opps, pd.DataFrame):
-        return impl(opps)
-    if isinstance(opps, pd.core.groupby.DataFrameGroupBy):
-        return opps.apply(impl)
-    raise UnexpectedTypeError(
-        name='opps',
-        actual=type(opps),
-        expected=[pd.DataFrame, pd.core.groupby.DataFrameGroupBy])
+
+def merge_dur_sketches(sketches: pd.DataFrame, by='symbol'):
+    """Merges the sketches of each group ('by' columns, e.g., a symbol's sketches of
+    several dates) by adding the counts of their buckets"""
+    by = list(ensure_iterable(by))
+    return sketches.groupby(
+        by + ['dur', 'key'], sort=True, observed=True)['count'].sum().astype(
+            'int64').reset_index()
+
+
+def get_sketch_dur_summary(sketches: pd.DataFrame, alpha=0.01, by='symbol', **kwargs):
+    """Gets the number of opps and the (approximate) duration quantiles of each group ('by'
+    columns) of the sketches, with the columns of get_opp_dur_summary.  A quantile is the
+    value (rounded to the ns) of the bucket of the duration at rank floor(q * (n - 1)), so
+    it's within 'alpha' (relative, plus the rounding) of that duration (numpy's 'lower'
+    quantile)."""
+    quantiles = ensure_iterable(
+        kwarg_picker.pick(kwargs, 'quantiles', 'quantile')
+        or [0.1 * i for i in range(1, 10)])
+    dur_cols = ensure_iterable(
+        kwarg_picker.pick_or(kwargs, ['lsn_win', 'fsn_win'], 'durs', 'dur'))
+    by = list(ensure_iterable(by))
+
+    merged = merge_dur_sketches(sketches, by=by)
+    keys = merged[by].drop_duplicates()
+    index = pd.MultiIndex.from_frame(keys) if len(by) > 1 else pd.Index(
+        keys[by[0]])
+    col_ns = {}
+    col_n = []
+    for col in dur_cols:
+        col_sketch = merged.loc[merged['dur'] == col]
+        col_index = pd.MultiIndex.from_frame(
+            col_sketch[by]) if len(by) > 1 else pd.Index(col_sketch[by[0]])
+        codes = index.get_indexer(col_index)
+        counts = col_sketch['count'].to_numpy()
+        n = np.bincount(codes, weights=counts, minlength=len(index)).astype('int64')
+        cum = np.cumsum(counts)
+        # (the rows are sorted by group, so each group's counts follow the previous groups')
+        base = np.r_[0, np.cumsum(n)[:-1]]
+        values = sketch_key_values(col_sketch['key'].to_numpy(), alpha)
+        col_n.append(n)
+        for q in quantiles:
+            rank = np.floor((n - 1) * q)
+            pos = np.searchsorted(cum, base + np.maximum(rank, 0), side='right')
+            res = np.full(len(index), np.nan)
+            res[n > 0] = np.round(values[pos[n > 0]])
+            col_ns[(q, col)] = res
+
+    # (in the column order of get_opp_dur_summary)
+    data = {'n_opps': np.max(col_n, axis=0) if col_n else np.zeros(len(index), 'int64')}
+    for q in quantiles:
+        for col in dur_cols:
+            data[fmt_quantile_col(q, prefix=col)] = ns_to_timedelta(col_ns[(q, col)])
+    return pd.DataFrame(data=data, index=index)
+
+
+def compare_sketch_to_exact(opps: pd.DataFrame, alpha=0.01, **kwargs):
+    """Compares the sketch quantiles of each symbol of the opps with the exact ('lower')
+    quantiles of the opps' durations.  Gets a row per (symbol, dur, quantile) with the exact
+    and sketch values, their relative error, and whether it's within the bound (alpha,
+    plus the rounding of the sketch value to the ns)."""
+    quantiles = ensure_iterable(
+        kwarg_picker.pick(kwargs, 'quantiles', 'quantile')
+        or [0.1 * i for i in range(1, 10)])
+    dur_cols = ensure_iterable(
+        kwarg_picker.pick_or(kwargs, ['lsn_win', 'fsn_win'], 'durs', 'dur'))
+    sketch_summ = get_sketch_dur_summary(
+        build_dur_sketches(opps, alpha, durs=dur_cols),
+        alpha,
+        by='symbol',
+        quantiles=quantiles,
+        durs=dur_cols)
+
+    symbol = opps.index.get_level_values('symbol').astype(str) if (
+        'symbol' in opps.index.names) else pd.Index(opps['symbol'].astype(str))
+    codes = sketch_summ.index.get_indexer(symbol)
+    frames = []
+    for col in dur_cols:
+        sorted_durs = SortedGroups(codes, to_ns(opps[col]), len(sketch_summ))
+        n = sorted_durs.ends - sorted_durs.starts
+        for q in quantiles:
+            exact = np.full(len(n), np.nan)
+            has_durs = n > 0
+            pos = sorted_durs.starts + np.floor((n - 1) * q).astype('int64')
+            exact[has_durs] = sorted_durs.values[pos[has_durs]]
+            sketch = to_ns(sketch_summ[fmt_quantile_col(q, prefix=col)])
+            abs_err = np.abs(sketch - exact)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel_err = np.where(abs_err == 0, 0.0, abs_err / np.abs(exact))
+            frames.append(
+                pd.DataFrame({
+                    'symbol': sketch_summ.index,
+                    'dur': col,
+                    'quantile': q,
+                    'n': n,
+                    'exact': ns_to_timedelta(exact),
+                    'sketch': ns_to_timedelta(sketch),
+                    'rel_err': rel_err,
+                    'is_within_bound': abs_err <= alpha * np.abs(exact) * (1 + 1e-9) + 0.5
+                }))
+    return pd.concat(frames, ignore_index=True)
+
+
+class OppDurSketchStore:
+    """Duration sketches (see build_dur_sketches) persisted as one feather file per
+    market_date (with the sketches of each of the date's symbols):
+
+        {root}/{key}/alpha={alpha}/market_date={date}.feather
+
+    so per-symbol quantiles of any range of dates are read from the (small) sketches of
+    those dates, without reloading their opps."""
+
+    def __init__(self, key='', alpha=0.01, store_root=None, log_level=1):
+        store_root = store_root if store_root is not None else '~/spartan_store/opp_dur_sketch'
+        _sketch_gamma(alpha)
+        self.alpha = alpha
+        self.__dir_path = os.path.join(
+            os.path.expanduser(store_root), key or 'default', f'alpha={alpha:g}')
+        self.__logger = Logger(log_level)
+
+    def dir_path(self):
+        return self.__dir_path
+
+    def partition_path(self, market_date):
+        market_date = pd.Timestamp(market_date).strftime('%Y-%m-%d')
+        return os.path.join(self.__dir_path, f'market_date={market_date}.feather')
+
+    def dates(self):
+        """Gets the sketched market dates"""
+        files = glob(os.path.join(self.__dir_path, 'market_date=*.feather'))
+        return sorted(
+            pd.Timestamp(os.path.basename(f)[len('market_date='):-len('.feather')])
+            for f in files)
+
+    def __read_partition(self, market_date):
+        df = pd.read_feather(self.partition_path(market_date))
+        df.insert(0, 'market_date', pd.Timestamp(market_date))
+        return df
+
+    def __write_partition(self, market_date, df):
+        write_atomic(
+            self.partition_path(market_date),
+            df.drop(columns='market_date').reset_index(drop=True).to_feather)
+
+    def write(self, sketches: pd.DataFrame, merge=False):
+        """Writes the sketches of each of their dates, replacing the date's sketches, or, if
+        'merge', adding to them (e.g., when opps are sketched in chunks)"""
+        for d, date_sketches in sketches.groupby('market_date', sort=True):
+            if merge and os.path.isfile(self.partition_path(d)):
+                date_sketches = merge_dur_sketches(
+                    pd.concat([self.__read_partition(d), date_sketches]),
+                    by=['market_date', 'symbol'])
+            self.__write_partition(d, date_sketches)
+
+    def update(self, opps: pd.DataFrame, overwrite=False, **kwargs):
+        """Sketches the opps of the dates that haven't been sketched (or of all of the opps'
+        dates, if 'overwrite'), and gets the number of dates written"""
+        market_date = pd.to_datetime(
+            opps.index.get_level_values('market_date') if 'market_date' in
+            opps.index.names else opps['market_date'])
+        if not overwrite:
+            is_new = ~market_date.isin(self.dates())
+            opps = opps.loc[is_new]
+            market_date = market_date[is_new]
+        if not len(opps):
+            return 0
+        self.__logger.log(
+            f'Sketching the durations of {market_date.nunique()} dates to {self.__dir_path}',
+            1)
+        self.write(build_dur_sketches(opps, self.alpha, **kwargs))
+        return market_date.nunique()
+
+    def read(self, market_dates=None, start=None, end=None, symbols=None):
+        """Reads the sketches of the market_dates (or of the dates in [start, end]), and of
+        the symbols"""
+        dates = self.dates()
+        if not is_none_or_empty(market_dates):
+            requested = {pd.Timestamp(d) for d in ensure_iterable(market_dates)}
+            missing = sorted(requested.difference(dates))
+            if missing:
+                self.__logger.log(
+                    f'No duration sketches of {[d.strftime("%Y-%m-%d") for d in missing]}',
+                    2)
+            dates = [d for d in dates if d in requested]
+        if start is not None:
+            dates = [d for d in dates if d >= pd.Timestamp(start)]
+        if end is not None:
+            dates = [d for d in dates if d <= pd.Timestamp(end)]
+        if not dates:
+            return pd.DataFrame(
+                columns=['market_date', 'symbol', 'dur', 'key', 'count'])
+        df = pd.concat([self.__read_partition(d) for d in dates], ignore_index=True)
+        if not is_none_or_empty(symbols):
+            df = df.loc[df['symbol'].isin([str(s) for s in ensure_iterable(symbols)])]
+        return df
+
+    def summary(self, market_dates=None, start=None, end=None, symbols=None, **kwargs):
+        """Gets the per-symbol duration summary (see get_sketch_dur_summary) of the dates"""
+        return get_sketch_dur_summary(
+            self.read(market_dates, start, end, symbols), self.alpha, **kwargs)
@@ -1,5 +1,7 @@
 from src.core.postgres_connection import PostgresConnection
 from src.synthetic_book_loader import SyntheticBookLoader
+from src.sniper_opp_mirror import SniperOppMirror
+from src.reference_data_snapshot import read_reference_data
 from src.core.iter_utils import ensure_iterable, is_none_or_empty
 import src.core.kwarg_picker as kwarg_picker
 from src.core.stopwatch_logger import StopwatchLogger
@@ -38,6 +40,39 @@ def uncommon_poly_regex():
     return '^(\+[1-9]|.*:.*)'
 
 
+def book_columns():
+    """The (heavy) book/event text columns of the sniper opps, which the 'summary' column
+    profile omits"""
+    return [
+        'exit_pbook', 'entry_ev', 'entry_pbook', 'entry_pbook_dir',
+        'entry_leg_books', 'exit_event', 'exit_pbook_dir', 'exit_leg_books',
+        'cp1_win', 'cp1_pbook', 'cp1_pbook_dir', 'cp2_win', 'cp2_pbook',
+        'cp2_pbook_dir'
+    ]
+
+
+def key_columns():
+    return ['run_id', 'opp_id', 'market_date', 'symbol', 'eid']
+
+
+def get_profile_columns(conn, table_name, profile=None, table_cols=None):
+    """Gets the select list of a column profile: 'full' (None, i.e., all columns),
+    'summary' (all but the book_columns), or a list of columns (to which the key_columns
+    are added).  The table's columns are queried unless specified ('table_cols')."""
+    if profile is None or profile == 'full':
+        return None
+    if isinstance(profile, str):
+        if profile != 'summary':
+            raise ValueError(
+                f"Unknown column profile '{profile}' (expected 'full' or 'summary')")
+        if table_cols is None:
+            table_cols = pd.read_sql(
+                f'select * from {table_name} limit 0', conn).columns
+        excluded = set(book_columns())
+        return [c for c in table_cols if c not in excluded]
+    return list(dict.fromkeys(key_columns() + list(profile)))
+
+
 def get_sorted_market_dates(market_dates):
     if market_dates is None:
         return None
@@ -69,104 +104,250 @@ def fmt_query_in_vals_clause(name, vals, wrap_in_quotes=False):
     return rv
 
 
-def _cast_and_filter_sniper_opps(src: pd.DataFrame, **kwargs):
-    """The cast procedure is combined with the filtering to reduce the size of the dataframe
-    before casting (most) columns. Some columns, however, must be cast before the filter is
-    applied, if they are the subject of a particular filter (e.g., symbols and market_dates)."""
-
-    df = src.copy()
+def sniper_opp_schema():
+    """The declared dtype of each (typed) sniper opp column, along with the replacement of
+    its NULLs (None if the column is never NULL)"""
+    return {
+        'run_id': ('uint32', None),
+        'opp_id': ('uint32', None),
+        'eid': ('int64', None),
+        'min_days': ('int64', -1),
+        'max_days': ('int64', -1),
+        'min_fut_vol': ('int64', -1),
+        'entry_ticks': ('int64', -1),
+        'side': ('category', None),
+        'has_futures': ('bool', None),
+        't_time': ('datetime64[ns]', 0),
+        'fsn_win': ('timedelta64[ns]', 0),
+        'lsn_win': ('timedelta64[ns]', 0),
+        'entry_pnl': ('float64', None),
+        'is_direct': ('bool', None),
+        'entry_qty': ('uint32', 0),
+    }
+
+
+def _cast_col(df: pd.DataFrame, col_name, dtype, nan_repl=None):
+    """Casts the column (in place) with a single conversion, which also replaces its NULLs"""
+    col = df[col_name]
+    if col.dtype == dtype:
+        return
+    if dtype == 'category':
+        df[col_name] = col.astype('category')
+        return
+    values = col.to_numpy()
+    is_na = col.isna().to_numpy() if nan_repl is not None else None
+    if is_na is not None and values.dtype == object:
+        # None can't be cast, so it's replaced first
+        values = np.where(is_na, nan_repl, values)
+        is_na = None
+    cast_dtype = 'int64' if dtype.startswith(('datetime64', 'timedelta64')) else dtype
+    with np.errstate(invalid='ignore'):
+        values = values.astype(cast_dtype)
+    if is_na is not None and is_na.any():
+        values[is_na] = nan_repl
+    # ns ints are viewed (not converted) as datetimes/timedeltas
+    df[col_name] = values.view(dtype) if cast_dtype != dtype else values
+
+
+def _cast_and_filter_sniper_opps(src: pd.DataFrame, inplace=False, **kwargs):
+    """The filter is applied before casting, to reduce the size of the dataframe before
+    casting (most) columns; only market_date is cast beforehand, as it's the subject of a
+    filter.  Each column of the sniper_opp_schema is then cast once, in place.  Unless
+    'inplace', the source is only copied if no rows are filtered out.  The result is only
+    sorted if the source isn't already ordered by (market_date, symbol, eid)."""
+
+    df = src
     symbols = CommonArgs.symbols(kwargs)
     market_dates = CommonArgs.market_dates(kwargs)
 
-    def cast_col(col_name, type_arg, nan_repl=None):
-        if nan_repl is not None:
-            df.at[df[col_name].isna(), col_name] = nan_repl
-        df[col_name] = df[col_name].astype(type_arg)
-
-    def cast_datetime(col_name, nan_repl=0):
-        cast_col(col_name, 'int64', nan_repl)
-        df[col_name] = pd.to_datetime(df[col_name], unit='ns')
-
-    def cast_timedelta(col_name, nan_repl=0):
-        cast_col(col_name, 'int64', nan_repl)
-        df[col_name] = pd.to_timedelta(df[col_name], unit='ns')
-
-    df['market_date'] = pd.to_datetime(df['market_date'])
-    sym_col = 'poly' if 'poly' in df else 'symbol'
     if 'poly' in df:
-        df['symbol'] = df['poly'].astype('category')
-        df.drop(columns='poly', inplace=True)
-    elif 'symbol' in df:
-        df['symbol'] = df['symbol'].astype('category')
+        df = df.rename(columns={'poly': 'symbol'}, copy=False)
+    market_date = pd.to_datetime(df['market_date'])
 
     filters = []
     if not is_none_or_empty(market_dates):
-        filters.append(df['market_date'].isin(market_dates))
+        filters.append(market_date.isin(pd.to_datetime(list(market_dates))))
     if not is_none_or_empty(symbols):
         filters.append(df['symbol'].isin(symbols))
     if filters:
-        df = df.loc[np.logical_and.reduce(filters)]
+        rows = np.flatnonzero(np.logical_and.reduce(filters))
+        df = df.take(rows)
+        market_date = market_date.take(rows)
+    elif not inplace:
+        df = df.copy()
+    df['market_date'] = market_date.to_numpy()
 
     if not is_none_or_empty(symbols):
         df['symbol'] = pd.Categorical(
-            df['symbol'], categories=symbols.cat.categories)
-    df['run_id'] = df['run_id'].astype('uint32')
-    df['opp_id'] = df['opp_id'].astype('uint32')
-    df['eid'] = df['eid'].astype('int64')
-    cast_col('min_days', 'int', -1)
-    cast_col('max_days', 'int', -1)
-    cast_col('min_fut_vol', 'int', -1)
-    cast_col('entry_ticks', 'int', -1)
-    df['side'] = df['side'].astype('category')
-    df['has_futures'] = df['has_futures'].astype('bool')
+            df['symbol'], categories=sorted(set(symbols)))
+    else:
+        df['symbol'] = df['symbol'].astype('category')
     if 'ht_time' in df:
         df.drop(columns='ht_time', inplace=True)
-    cast_datetime('t_time')
-    df['t_tod'] = df['t_time'] - df['market_date'] - pd.Timedelta('1d')
-    cast_timedelta('fsn_win')
-    cast_timedelta('lsn_win')
-    df['entry_pnl'] = df['entry_pnl'].astype('float')
-    df['is_direct'] = df['is_direct'].astype('bool')
-    cast_col('entry_qty', 'uint32', 0)
+    for col_name, (dtype, nan_repl) in sniper_opp_schema().items():
+        if col_name in df:
+            _cast_col(df, col_name, dtype, nan_repl)
+    if 't_time' in df:
+        df['t_tod'] = df['t_time'] - df['market_date'] - pd.Timedelta('1d')
 
     df['is_bf'] = df['symbol'].str.contains('BF')
-    df['tot_ticks'] = df['entry_ticks'] * df['entry_qty']
+    if 'entry_ticks' in df and 'entry_qty' in df:
+        df['tot_ticks'] = df['entry_ticks'] * df['entry_qty']
 
-    df = df.set_index(['market_date', 'symbol', 'eid']).sort_index()
+    df.set_index(['market_date', 'symbol', 'eid'], inplace=True)
+    if not df.index.is_monotonic_increasing:
+        df.sort_index(inplace=True)
     return df
 
 
+class QueryParams:
+    """Bound (rather than string formatted) parameters of a query, for either sqlite3 or
+    SQLAlchemy connections.  Long sqlite value lists are inserted into temp tables (and
+    joined), and postgres value lists are bound as arrays."""
+
+    max_sqlite_in_vals = 500
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.is_sqlite = isinstance(conn, sqlite3.Connection)
+        self.is_postgres = not self.is_sqlite and conn.dialect.name == 'postgresql'
+        self.params = [] if self.is_sqlite else {}
+        self.__expanding = []
+        self.__temp_tables = []
+
+    def in_clause(self, name, vals, sql_type=None):
+        """'sql_type' is the column's type (e.g., 'date'), to which postgres arrays are
+        cast (as arrays of str are otherwise bound as text[])"""
+        vals = list(ensure_iterable(vals))
+        if not self.is_sqlite:
+            self.params[name] = vals
+            if self.is_postgres:
+                if sql_type is not None:
+                    return f'{name} = any(cast(:{name} as {sql_type}[]))'
+                return f'{name} = any(:{name})'
+            self.__expanding.append(name)
+            return f'{name} in :{name}'
+        if len(vals) <= QueryParams.max_sqlite_in_vals:
+            self.params.extend(vals)
+            return f'{name} in ({", ".join("?" * len(vals))})'
+        table = f'temp_in_{name}'
+        self.conn.execute(f'drop table if exists {table}')
+        self.conn.execute(f'create temp table {table} (v)')
+        self.conn.executemany(
+            f'insert into {table} values (?)', [(v, ) for v in vals])
+        self.__temp_tables.append(table)
+        return f'{name} in (select v from {table})'
+
+    def query(self, query):
+        if self.is_sqlite:
+            return query
+        from sqlalchemy import bindparam, text
+        return text(query).bindparams(
+            *[bindparam(n, expanding=True) for n in self.__expanding])
+
+    def drop_temp_tables(self):
+        for table in self.__temp_tables:
+            self.conn.execute(f'drop table if exists {table}')
+        self.__temp_tables = []
+
+
+def fmt_query_str_vals(vals):
+    return [v if isinstance(v, str) else str(v) for v in ensure_iterable(vals)]
+
+
+def read_sql_chunks(conn, query, params=None, chunksize=100000):
+    """Yields the query result in chunks (of rows).  SQLAlchemy engines are read with a
+    server-side cursor, so the full result is never held in memory at once."""
+    from sqlalchemy.engine import Engine
+    if not isinstance(conn, Engine):
+        yield from pd.read_sql(query, conn, params=params, chunksize=chunksize)
+        return
+    with conn.connect() as c:
+        c = c.execution_options(stream_results=True)
+        yield from pd.read_sql(query, c, params=params, chunksize=chunksize)
+
+
 def get_channel_runs(conn, channels):
-    channel_clause = fmt_query_in_vals_clause('channel', channels)
-    runs = pd.read_sql(f'select * from run where {channel_clause}', conn)
+    qp = QueryParams(conn)
+    channel_clause = qp.in_clause('channel', channels)
+    runs = pd.read_sql(
+        qp.query(f'select * from run where {channel_clause}'), conn,
+        params=qp.params)
+    qp.drop_temp_tables()
     return runs
 
 
 def from_conn(conn, **kwargs):
+    """Reads the (typed) sniper opps of the channels/symbols/market_dates.  Only the
+    columns of the column profile ('columns': 'full', 'summary' or a list) are selected.
+    Rows are streamed in chunks of 'chunksize', and each chunk is cast and filtered as it
+    arrives.  If a SniperOppMirror is specified ('mirror'), the opps are read from it
+    instead (unless a 'limit' is specified, or it's missing any of the channels' current
+    runs in the db).  If 'sync' is True, the missing runs are fetched into the mirror
+    first (otherwise they're read from the db)."""
     channels = CommonArgs.channels(kwargs)
     symbols = CommonArgs.symbols(kwargs)
     market_dates = CommonArgs.market_dates(kwargs)
     table_name = CommonArgs.table_name(kwargs, 'typed_sniper_opps')
     limit = kwargs.get('limit')
-    query = f'select * from {table_name}'
+    chunksize = kwarg_picker.pick_or(kwargs, 100000, 'chunksize', 'chunk_sz')
+    profile = kwarg_picker.pick(kwargs, 'columns', 'cols', 'profile')
+    mirror = kwargs.get('mirror')
+    runs = None if channels is None else get_channel_runs(conn, channels)
+    if mirror is not None and limit is None:
+        # (the db's current runs, so runs added since the mirror was synced aren't missed)
+        if runs is None:
+            run_ids = {int(r) for r in pd.read_sql('select run_id from run', conn)['run_id']}
+        else:
+            run_ids = {int(r) for r in runs['run_id']}
+        if kwargs.get('sync', False) and not run_ids.issubset(mirror.mirrored_run_ids()):
+            mirror.sync(conn, channels=channels, chunksize=chunksize)
+        mirror_cols = mirror.columns()
+        df = None if mirror_cols is None else mirror.read(
+            channels=channels,
+            market_dates=market_dates,
+            symbols=None if symbols is None else fmt_query_str_vals(symbols),
+            columns=get_profile_columns(
+                conn, table_name, profile, table_cols=mirror_cols),
+            run_ids=run_ids)
+        if df is not None:
+            return _cast_and_filter_sniper_opps(df, inplace=True)
+    columns = get_profile_columns(conn, table_name, profile)
+    qp = QueryParams(conn)
+    select_list = '*' if columns is None else ', '.join(columns)
+    query = f'select {select_list} from {table_name}'
     clauses = ['symbol!=\'\'']
     if channels is not None:
-        runs = get_channel_runs(conn, channels)
-        clauses.append(fmt_query_in_vals_clause('run_id', runs['run_id']))
-    if symbols is not None:
         clauses.append(
-            fmt_query_in_vals_clause('symbol', symbols, wrap_in_quotes=True))
+            qp.in_clause('run_id', [int(r) for r in runs['run_id']]))
+    if symbols is not None:
+        clauses.append(qp.in_clause('symbol', fmt_query_str_vals(symbols)))
     if market_dates is not None:
         clauses.append(
-            fmt_query_in_vals_clause(
-                'market_date', market_dates, wrap_in_quotes=True))
+            qp.in_clause(
+                'market_date', fmt_query_str_vals(market_dates), sql_type='date'))
     query += ' where ' + ' and '.join(clauses)
     if limit is not None:
-        query += f' limit {limit}'
+        query += f' limit {int(limit)}'
     print(f'Reading sql query: {query}')
-    df = pd.read_sql(query, conn)
-    df = _cast_and_filter_sniper_opps(
-        df, dates=get_sorted_market_dates(market_dates))
+    sorted_market_dates = get_sorted_market_dates(market_dates)
+    try:
+        chunks = [
+            _cast_and_filter_sniper_opps(
+                chunk, inplace=True, dates=sorted_market_dates)
+            for chunk in read_sql_chunks(
+                conn, qp.query(query), qp.params, chunksize)
+        ]
+    finally:
+        qp.drop_temp_tables()
+    if len(chunks) == 1:
+        return chunks[0]
+    df = pd.concat(objs=chunks)
+    # the chunks' symbol categories differ (and so are lost on concat)
+    df.index = df.index.set_levels(
+        pd.CategoricalIndex(df.index.levels[1]), level='symbol')
+    if not df.index.is_monotonic_increasing:
+        df.sort_index(inplace=True)
     return df
 
 
@@ -178,7 +359,8 @@ def from_sqlite(asset, **kwargs):
             kwargs, 'market_dates', 'market_date', 'dates', 'date'), None)
     conn = sqlite3.connect(f'/md/SIM_DBs/sim_{asset}.sqlite')
     df = pd.read_sql('select * from sniper_opps', conn)
-    return _cast_and_filter_sniper_opps(df, symbols, market_dates)
+    return _cast_and_filter_sniper_opps(
+        df, inplace=True, symbols=symbols, dates=market_dates)
 
 
 def from_postgres(**kwargs):
@@ -235,12 +417,21 @@ class SniperOppLoader:
             'synths', 'synth')
         opp_roots = kwarg_picker.pick_or(kwargs, {}, 'opp_roots', 'opp_root')
         opps = kwarg_picker.pick_or(kwargs, {}, 'opps', 'opp')
+        mirror_root = kwarg_picker.pick(kwargs, 'mirror_root', 'mirror')
         log_level = SniperOppLoader.__pick_log_level(kwargs, 1)
 
-        pg_conn = PostgresConnection(host='titan').connect()
+        # None disables the (on-disk) reference data snapshot
+        snapshot_ttl = kwarg_picker.pick_or(kwargs, '1d', 'snapshot_ttl', 'ttl')
+
+        pg = PostgresConnection(host='titan')
+        queries = {'synthetic_exchange_fee': 'select * from synthetic_exchange_fee'}
+        if synth_sec is None:
+            queries['synthetic_security_polygons'] = \
+                'select * from synthetic_security where is_polygon'
+        ref_data = read_reference_data(
+            pg.connect, queries, pg.host, ttl=snapshot_ttl, log_level=log_level)
         if synth_sec is None:
-            synth_sec = pd.read_sql(
-                'select * from synthetic_security where is_polygon', pg_conn)
+            synth_sec = ref_data['synthetic_security_polygons']
         if symbols is not None:
             synth_sec = synth_sec.loc[synth_sec['symbol'].isin(symbols)]
         fee_cols = {
@@ -248,9 +439,7 @@ class SniperOppLoader:
             for c in ['nonmember_fee', 'member_fee', 'member106j_fee']
         }
         if any(fee_cols.values()):
-            synth_fee = pd.read_sql(
-                'select * from synthetic_exchange_fee', pg_conn)
-            synth_fee = synth_fee.drop(
+            synth_fee = ref_data['synthetic_exchange_fee'].drop(
                 columns=list(
                     map(
                         lambda x: x[0], filter(
@@ -270,6 +459,20 @@ class SniperOppLoader:
         self.__synth_sec = synth_sec
         self.__synth_bk = synth_bk
         self.__log_level = log_level
+        # the root of the local mirror of the opp tables (True for the default root), which
+        # is disabled unless specified
+        self.__mirror_root = mirror_root
+
+    def mirror(self, key='', table_name=None):
+        """Gets the local mirror of the key's opp table (None if disabled).  Opps are read
+        from it once it's been synced (see SniperOppMirror.sync)."""
+        if self.__mirror_root is None or self.__mirror_root is False:
+            return None
+        return SniperOppMirror(
+            key,
+            table_name=table_name or 'typed_sniper_opps',
+            store_root=None if self.__mirror_root is True else self.__mirror_root,
+            log_level=self.__log_level)
 
     def synth_bk(self):
         if self.__synth_bk is None:
@@ -283,9 +486,15 @@ class SniperOppLoader:
         return self.__synth_sec
 
     def load_asset_opp_root(self, key='', **kwargs):
-        """Loads the core data, from which opps """
-        if key in self.__opp_roots:
-            return self.__opp_roots[key]
+        """Loads the core data, from which opps are summarized.  'columns' selects a column
+        profile ('full' (default), 'summary' or a list, see get_profile_columns); roots are
+        cached per (key, profile).  Opps are read through the key's local mirror, if enabled
+        and synced (see SniperOppLoader.mirror)."""
+        profile = kwarg_picker.pick_or(kwargs, 'full', 'columns', 'cols', 'profile')
+        cache_key = key if profile == 'full' else (
+            key, profile if isinstance(profile, str) else tuple(profile))
+        if cache_key in self.__opp_roots:
+            return self.__opp_roots[cache_key]
 
         def fmt_len_vals(x):
             return 'all' if x is None else len(x)
@@ -304,8 +513,10 @@ class SniperOppLoader:
                 symbol=symbols,
                 dates=self.__market_dates,
                 table_name=CommonArgs.table_name(kwargs),
-                limit=kwargs.get('limit'))
-            self.__opp_roots[key] = df
+                limit=kwargs.get('limit'),
+                columns=profile,
+                mirror=self.mirror(key, CommonArgs.table_name(kwargs)))
+            self.__opp_roots[cache_key] = df
             return df
 
     def load(self, key='', **kwargs):
@@ -313,16 +524,18 @@ class SniperOppLoader:
             return self.__opp_summs[key]
 
         log_level = SniperOppLoader.__pick_log_level(kwargs, self.__log_level)
-        df = self.load_asset_opp_root(key, log_level=log_level).copy()
-
-        cols_to_drop = [
-            'exit_pbook', 'entry_ev', 'entry_pbook', 'entry_pbook_dir',
-            'entry_leg_books', 'exit_event', 'exit_pbook', 'exit_pbook_dir',
-            'exit_leg_books', 'cp1_win', 'cp1_pbook', 'cp1_pbook_dir',
-            'cp2_win', 'cp2_pbook', 'cp2_pbook_dir', 't_time'
-        ]
-        cols_to_drop = [c for c in cols_to_drop if c in df]
-        df = self.load_asset_opp_root(
-            key, log_level=log_level).copy().drop(columns=cols_to_drop)
+        # derive the summary from an already loaded full root, rather than re-querying
+        profile = 'full' if key in self.__opp_roots else 'summary'
+        summary_key = (key, 'summary')
+        is_cached = key in self.__opp_roots or summary_key in self.__opp_roots
+        df = self.load_asset_opp_root(key, log_level=log_level, columns=profile)
+        cols_to_drop = [c for c in book_columns() + ['t_time'] if c in df]
+        if is_cached:
+            df = df.drop(columns=cols_to_drop)
+        else:
+            # (the summary root was only loaded for this, so it's trimmed rather than
+            # cached alongside its copy)
+            del self.__opp_roots[summary_key]
+            df.drop(columns=cols_to_drop, inplace=True)
         self.__opp_summs[key] = df
         return df
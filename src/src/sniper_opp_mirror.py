@@ -0,0 +1,196 @@
+from src.core.logger import Logger
+from src.core.file_utils import write_atomic, write_json_atomic
+from src.core.iter_utils import ensure_iterable, is_none_or_empty
+
+from glob import glob
+import json
+import os
+import os.path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+class SniperOppMirror:
+    """A local parquet mirror of a database's (typed) sniper opps and run tables.  Opps are
+    partitioned by channel and market_date, with one file per run:
+
+        {root}/{key}/{table_name}/channel={channel}/market_date={date}/run_{run_id}.parquet
+
+    Runs are mirrored whole (with the sniper_opp_schema dtypes applied), and sync only
+    fetches the runs (of the requested channels) that haven't been mirrored yet.
+    Within a file, rows are sorted by (symbol, eid), so symbol filters can skip row groups."""
+
+    row_group_size = 64 * 1024
+
+    def __init__(
+            self,
+            key='',
+            table_name='typed_sniper_opps',
+            store_root=None,
+            log_level=1):
+        store_root = store_root if store_root is not None else '~/spartan_store/sniper_opp_mirror'
+        self.__root = os.path.join(
+            os.path.expanduser(store_root), key or 'default')
+        self.__table_name = table_name
+        self.__logger = Logger(log_level)
+
+    def root(self):
+        return self.__root
+
+    def table_path(self):
+        return os.path.join(self.__root, self.__table_name)
+
+    def run_path(self):
+        return os.path.join(self.__root, 'run.parquet')
+
+    def manifest_path(self):
+        return os.path.join(self.table_path(), 'manifest.json')
+
+    def partition_path(self, channel, market_date):
+        market_date = pd.Timestamp(market_date).strftime('%Y-%m-%d')
+        return os.path.join(
+            self.table_path(), f'channel={channel}', f'market_date={market_date}')
+
+    def __read_manifest(self):
+        if not os.path.isfile(self.manifest_path()):
+            return {'runs': {}}
+        with open(self.manifest_path()) as f:
+            return json.load(f)
+
+    def __write_manifest(self, manifest):
+        write_json_atomic(self.manifest_path(), manifest)
+
+    def mirrored_run_ids(self):
+        return {int(r) for r in self.__read_manifest()['runs']}
+
+    def runs(self):
+        """Gets the mirrored run table (None if it hasn't been synced)"""
+        if not os.path.isfile(self.run_path()):
+            return None
+        return pd.read_parquet(self.run_path())
+
+    @staticmethod
+    def __select_runs(runs, channels=None):
+        if not is_none_or_empty(channels):
+            runs = runs.loc[runs['channel'].isin(ensure_iterable(channels))]
+        return runs
+
+    def sync(self, conn, channels=None, chunksize=100000):
+        """Refreshes the mirrored run table, and fetches the opps of the runs (of the
+        channels) that haven't been mirrored yet (a run's opps may span several dates, so
+        runs are fetched whole, and new dates arrive with new runs).  The manifest is updated as
+        each run is written, so an interrupted sync resumes where it stopped."""
+        # (deferred, as sniper_opp_loader reads through the mirror)
+        from src.sniper_opp_loader import QueryParams, read_sql_chunks, \
+            sniper_opp_schema, _cast_col
+
+        runs = pd.read_sql('select * from run', conn)
+        write_atomic(self.run_path(), runs.to_parquet)
+        runs = SniperOppMirror.__select_runs(runs, channels)
+        mirrored = self.mirrored_run_ids()
+        missing = [
+            (int(r), c)
+            for r, c in zip(runs['run_id'], runs['channel'])
+            if int(r) not in mirrored
+        ]
+        if not missing:
+            return 0
+        self.__logger.log(
+            f'Mirroring {len(missing)} runs of {self.__table_name} to {self.table_path()}',
+            1)
+        schema = sniper_opp_schema()
+        manifest = self.__read_manifest()
+        for run_id, channel in missing:
+            qp = QueryParams(conn)
+            query = f'select * from {self.__table_name} where {qp.in_clause("run_id", [run_id])}'
+            chunks = []
+            try:
+                for chunk in read_sql_chunks(
+                        conn, qp.query(query), qp.params, chunksize):
+                    for col_name, (dtype, nan_repl) in schema.items():
+                        if col_name in chunk:
+                            _cast_col(chunk, col_name, dtype, nan_repl)
+                    chunks.append(chunk)
+            finally:
+                qp.drop_temp_tables()
+            df = pd.concat(chunks, ignore_index=True) if chunks else None
+            n_rows = 0 if df is None else len(df)
+            if n_rows:
+                market_date = pd.to_datetime(df['market_date'])
+                for d, date_df in df.groupby(market_date, sort=False):
+                    date_df = date_df.sort_values(['symbol', 'eid'])
+                    table = pa.Table.from_pandas(date_df, preserve_index=False)
+                    write_atomic(
+                        os.path.join(
+                            self.partition_path(channel, d),
+                            f'run_{run_id}.parquet'),
+                        lambda p: pq.write_table(
+                            table, p,
+                            row_group_size=SniperOppMirror.row_group_size))
+            manifest['runs'][str(run_id)] = {
+                'channel': int(channel),
+                'n_rows': n_rows,
+                'synced_at': pd.Timestamp.now().isoformat()
+            }
+            self.__write_manifest(manifest)
+        return len(missing)
+
+    def columns(self):
+        """Gets the mirrored columns (None if no opps have been mirrored)"""
+        files = glob(os.path.join(self.table_path(), '*', '*', '*.parquet'))
+        if not files:
+            return None
+        return pq.read_schema(files[0]).names
+
+    def read(
+            self, channels=None, market_dates=None, symbols=None, columns=None,
+            run_ids=None):
+        """Reads the mirrored opps of the channels/market_dates/symbols (projected to the
+        columns), pruning partitions by channel/market_date and row groups by symbol.
+        The requested runs are the channels' runs of the mirrored run table, unless
+        'run_ids' (e.g., the db's current runs) are specified.
+        Returns None if any of the requested runs haven't been mirrored (or if no opps have
+        been mirrored, so there's no schema), and an empty frame if they have, but have no
+        opps of the dates."""
+        if run_ids is None:
+            runs = self.runs()
+            if runs is None:
+                return None
+            runs = SniperOppMirror.__select_runs(runs, channels)
+            run_ids = {int(r) for r in runs['run_id']}
+        run_ids = {int(r) for r in run_ids}
+        if not run_ids.issubset(self.mirrored_run_ids()):
+            return None
+        if is_none_or_empty(market_dates):
+            date_dirs = ['*']
+        else:
+            date_dirs = [
+                f'market_date={pd.Timestamp(d).strftime("%Y-%m-%d")}'
+                for d in ensure_iterable(market_dates)
+            ]
+        channel_dirs = ['*'] if is_none_or_empty(channels) else [
+            f'channel={c}' for c in ensure_iterable(channels)
+        ]
+        files = sorted(
+            f for c in channel_dirs for d in date_dirs
+            for f in glob(os.path.join(self.table_path(), c, d, 'run_*.parquet'))
+            if int(os.path.basename(f)[4:-8]) in run_ids)
+        if not files:
+            all_files = glob(os.path.join(self.table_path(), '*', '*', '*.parquet'))
+            if not all_files:
+                return None
+            schema = pq.read_schema(all_files[0])
+            if columns is not None:
+                schema = pa.schema([f for f in schema if f.name in columns])
+            return schema.empty_table().to_pandas()
+        dataset = ds.dataset(files, format='parquet')
+        if columns is not None:
+            columns = [c for c in dataset.schema.names if c in columns]
+        # (as in the queries of sniper_opp_loader.from_conn)
+        filter_expr = ds.field('symbol') != ''
+        if not is_none_or_empty(symbols):
+            filter_expr = filter_expr & ds.field('symbol').isin(
+                [str(s) for s in ensure_iterable(symbols)])
+        return dataset.to_table(columns=columns, filter=filter_expr).to_pandas()
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+
+class SyntheticBookIndex:
+    """Contiguous per-column arrays of a single date's synth book (sorted by symbol,
+    eid), along with the row offsets of each symbol.  Symbol lookups return views
+    of the arrays, so opps can be located without slicing/copying the synth book."""
+
+    columns = ['t_time', 'fs_time', 'ls_time', 'bk_dur', 'bid_p_1', 'ask_p_1']
+
+    def __init__(self, symbols, offsets, eid, **arrays):
+        missing = [c for c in SyntheticBookIndex.columns if c not in arrays]
+        if missing:
+            raise ValueError(f'Missing synth book columns: {missing}')
+        if len(offsets) != len(symbols) + 1:
+            raise ValueError(
+                f'Expected {len(symbols) + 1} offsets (got {len(offsets)})')
+        self.symbols = list(symbols)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.eid = eid
+        self.arrays = arrays
+        self.__symbol_idx = {s: i for i, s in enumerate(self.symbols)}
+
+    @staticmethod
+    def from_synth_book(date_sb: pd.DataFrame):
+        """Builds the index from a single date of a synth book indexed by
+        (market_date, symbol, eid)"""
+        sb_symbols = date_sb.index.get_level_values('symbol')
+        starts = np.r_[0, np.flatnonzero(sb_symbols[1:] != sb_symbols[:-1]) + 1]
+
+        def to_numpy(col):
+            # e.g., nullable (compact schema) tick prices
+            if pd.api.types.is_extension_array_dtype(col.dtype):
+                return col.to_numpy(dtype='float64', na_value=np.nan)
+            return np.ascontiguousarray(col.to_numpy())
+
+        arrays = {c: to_numpy(date_sb[c]) for c in SyntheticBookIndex.columns}
+        return SyntheticBookIndex(
+            symbols=sb_symbols[starts] if len(date_sb) else [],
+            offsets=np.r_[starts, len(date_sb)] if len(date_sb) else [0],
+            eid=np.ascontiguousarray(
+                date_sb.index.get_level_values('eid').to_numpy()),
+            **arrays)
+
+    def __len__(self):
+        return len(self.eid)
+
+    def symbol_range(self, symbol):
+        """Gets the [lo, hi) rows of the symbol (empty if it has no books)"""
+        i = self.__symbol_idx.get(symbol)
+        if i is None:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    def symbol_view(self, symbol):
+        """Gets the eid and column arrays of the symbol (views, not copies)"""
+        lo, hi = self.symbol_range(symbol)
+        rv = {c: a[lo:hi] for c, a in self.arrays.items()}
+        rv['eid'] = self.eid[lo:hi]
+        return rv
+
+    def locate_opp_windows(self, opp_symbols, opp_start_eids, delay):
+        """Gets the [start, stop) rows of each opp.  The start row is the symbol's last
+        book at or before the opp's start eid, and the window extends through the last book
+        whose t_time is within 'delay' of the start row's t_time.  Opps that can't be
+        located (no prior book for the symbol) get an empty range.  The opps must be
+        sorted by symbol."""
+        opp_start_eids = np.asarray(opp_start_eids)
+        delay = np.timedelta64(pd.Timedelta(delay).value, 'ns')
+        starts = np.zeros(len(opp_start_eids), dtype='int64')
+        stops = np.zeros(len(opp_start_eids), dtype='int64')
+        if len(opp_start_eids) == 0:
+            return starts, stops
+
+        opp_symbols = np.asarray(opp_symbols, dtype='object')
+        sym_bounds = np.flatnonzero(opp_symbols[1:] != opp_symbols[:-1]) + 1
+        t_time = self.arrays['t_time']
+        for lo, hi in zip(np.r_[0, sym_bounds],
+                          np.r_[sym_bounds, len(opp_start_eids)]):
+            sb_lo, sb_hi = self.symbol_range(opp_symbols[lo])
+            if sb_lo == sb_hi:
+                continue
+            sym_t_time = t_time[sb_lo:sb_hi]
+            sym_starts = np.searchsorted(
+                self.eid[sb_lo:sb_hi], opp_start_eids[lo:hi], side='right') - 1
+            is_located = sym_starts >= 0
+            sym_starts = np.where(is_located, sym_starts, 0)
+            sym_stops = np.searchsorted(
+                sym_t_time, sym_t_time[sym_starts] + delay, side='right')
+            starts[lo:hi] = np.where(is_located, sym_starts + sb_lo, 0)
+            stops[lo:hi] = np.where(is_located, sym_stops + sb_lo, 0)
+        return starts, stops
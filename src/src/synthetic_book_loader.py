@@ -1,5 +1,5 @@
 from src.core.logger import Logger
-# from src.core import chunker
+from src.core.chunker import get_chunks
 from src.core.iter_utils import ensure_iterable, fmt_iterable
 from src.pcap_location_params import PCapLocationParams
 from src.core.stopwatch_logger import StopwatchLogger
@@ -7,7 +7,14 @@ import src.core.kwarg_picker as kwarg_picker
 
 # from multiprocessing import Pool, Process, Manager, cpu_count
 from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import numpy as np
 import pandas as pd
+import re
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as fs
 # import time
 
 
@@ -17,6 +24,179 @@ def deduce_opp_eids(synth_bk, bid='bid_p_1', ask='ask_p_1'):
     return synth_bk
 
 
+def _read_feather(path, columns=None, filter_fn=None):
+    """Reads a feather file as a memory mapped dataset, projected to the specified columns
+    (those missing from the file are ignored).  'filter_fn' gets the file's schema and
+    returns a pyarrow filter expression (or None)."""
+    dataset = ds.dataset(
+        path, format='feather', filesystem=fs.LocalFileSystem(use_mmap=True))
+    if columns is not None:
+        columns = [c for c in dataset.schema.names if c in columns]
+    filter_expr = filter_fn(dataset.schema) if filter_fn is not None else None
+    return dataset.to_table(columns=columns, filter=filter_expr).to_pandas()
+
+
+def _get_range_filter(col_name, lo=None, hi=None):
+    """Gets a filter_fn (see _read_feather) for lo <= col < hi.  lo/hi are cast to the
+    column's type (e.g., Timestamps may bound either timestamp (of any unit) or int64 ns
+    columns)."""
+    if lo is None and hi is None:
+        return None
+
+    def impl(schema):
+        if col_name not in schema.names:
+            return None
+        typ = schema.field(col_name).type
+
+        def to_scalar(x):
+            if isinstance(x, (pd.Timestamp, pd.Timedelta)):
+                x = x.value
+                if pa.types.is_timestamp(typ) or pa.types.is_duration(typ):
+                    # ns to the column's unit, rounding up (as both bounds are compared to
+                    # whole units, lo <= col and col < hi hold for the rounded up bounds)
+                    unit_ns = {'s': 10**9, 'ms': 10**6, 'us': 10**3, 'ns': 1}[typ.unit]
+                    x = -(-x // unit_ns)
+            return pa.scalar(x, type=pa.int64()).cast(typ)
+
+        rv = None
+        if lo is not None:
+            rv = ds.field(col_name) >= to_scalar(lo)
+        if hi is not None:
+            hi_expr = ds.field(col_name) < to_scalar(hi)
+            rv = hi_expr if rv is None else rv & hi_expr
+        return rv
+
+    return impl
+
+
+def _and_filters(*filter_fns):
+    filter_fns = [f for f in filter_fns if f is not None]
+    if not filter_fns:
+        return None
+
+    def impl(schema):
+        exprs = [e for e in (f(schema) for f in filter_fns) if e is not None]
+        if not exprs:
+            return None
+        rv = exprs[0]
+        for e in exprs[1:]:
+            rv = rv & e
+        return rv
+
+    return impl
+
+
+def _take_event_info(ei, eid):
+    """Gets the event info columns of each of the eids (a left join on eid).  The event info
+    eids are dense and increasing, so rows are looked up by position (eid - eid0) rather
+    than hashed.  Eids without event info get NA."""
+    if not ei['eid'].is_monotonic_increasing:
+        ei = ei.sort_values('eid')
+    ei_eid = ei['eid'].to_numpy()
+    if len(ei_eid) > 0 and ei_eid[-1] - ei_eid[0] + 1 == len(ei_eid):
+        pos = eid - ei_eid[0]
+    else:
+        pos = np.searchsorted(ei_eid, eid)
+    is_valid = (pos >= 0) & (pos < len(ei_eid))
+    is_valid[is_valid] = ei_eid[pos[is_valid]] == eid[is_valid]
+    pos = np.where(is_valid, pos, -1)
+    return {
+        c: pd.api.extensions.take(ei[c].array, pos, allow_fill=True)
+        for c in ei.columns if c != 'eid'
+    }
+
+
+def _is_price_col(col_name):
+    return re.match(r'^i?(bid|ask)_p_[0-9]+$', col_name) is not None
+
+
+def _is_qty_col(col_name):
+    return re.match(r'^i?(bid|ask)_q_[0-9]+$', col_name) is not None
+
+
+def _to_compact_schema(sb_df, sym_codes, categories, tick_sizes):
+    """Converts the (float) prices to int32 ticks of the symbol's tick size, and the
+    quantities to uint32, in place.  Columns with missing values get the nullable
+    equivalents (Int32, UInt32).  Price columns with prices off the tick grid are left as
+    float (rather than rounded), and are returned."""
+    sym_tick_sizes = np.array(
+        [tick_sizes.get(s, np.nan) for s in categories], dtype='float64')
+    if np.isnan(sym_tick_sizes[np.unique(sym_codes)]).any():
+        raise ValueError('Tick sizes are required for all symbols')
+    row_tick_sizes = sym_tick_sizes[sym_codes]
+
+    def impl(col_name, values, dtype):
+        is_na = np.isnan(values)
+        values = np.where(is_na, 0, values).astype(dtype)
+        if is_na.any():
+            values = pd.arrays.IntegerArray(values, is_na)
+        sb_df[col_name] = values
+
+    off_grid_cols = []
+    for c in sb_df.columns:
+        if _is_price_col(c):
+            prices = sb_df[c].to_numpy(dtype='float64')
+            ticks = np.round(prices / row_tick_sizes)
+            with np.errstate(invalid='ignore'):
+                is_on_grid = np.isclose(
+                    ticks * row_tick_sizes, prices, rtol=1e-9, atol=1e-9)
+            if not is_on_grid[~np.isnan(prices)].all():
+                off_grid_cols.append(c)
+                continue
+            impl(c, ticks, 'int32')
+        elif _is_qty_col(c):
+            impl(c, sb_df[c].to_numpy(dtype='float64'), 'uint32')
+    return off_grid_cols
+
+
+def from_ticks(sb, tick_sizes, columns=None):
+    """Gets the (float) prices of a compact schema synth book (see
+    SyntheticBookLoader.tick_sizes), or of a merged opp book of one (whose 'edge' is in
+    ticks as well), for display.  Returns a frame of the price columns and edge (or the
+    specified columns).  Integer (tick) columns are converted, and price columns left as
+    float by the compact schema (off the tick grid) are already prices."""
+    if columns is None:
+        columns = [c for c in sb.columns if _is_price_col(c) or c == 'edge']
+    row_tick_sizes = pd.Series(tick_sizes).reindex(
+        sb.index.get_level_values('symbol')).to_numpy(dtype='float64')
+
+    def is_ticks(c):
+        if c == 'edge':
+            # (edge is computed from the (possibly nullable, so float) top of book prices)
+            return all(
+                c in sb and pd.api.types.is_integer_dtype(sb[c].dtype)
+                for c in ['bid_p_1', 'ask_p_1'])
+        return pd.api.types.is_integer_dtype(sb[c].dtype)
+
+    return pd.DataFrame(
+        data={
+            c: sb[c].to_numpy(dtype='float64', na_value=np.nan) *
+            (row_tick_sizes if is_ticks(c) else 1)
+            for c in columns
+        },
+        index=sb.index)
+
+
+def _get_next_t_time(t_time, sym_codes):
+    """Gets the t_time of each book's successor (of the same symbol), which is NaT for each
+    symbol's last book.  t_time must be ordered by (symbol, eid)."""
+    rv = np.roll(t_time, -1)
+    is_last = np.ones(len(t_time), dtype='bool')
+    is_last[:-1] = sym_codes[1:] != sym_codes[:-1]
+    rv[is_last] = np.datetime64('NaT')
+    return rv
+
+
+def get_worker_counts(n_dates, n_pids, n_cores=None):
+    """Gets the number of processes (one date each) and the number of threads per process
+    (one polygon read each) for loading synth books.  The polygon reads are I/O bound, so
+    the cores are oversubscribed with threads (mostly relevant when there are few dates)."""
+    n_cores = n_cores or cpu_count()
+    n_procs = max(1, min(n_dates, n_cores))
+    n_threads = max(1, min(n_pids, (2 * n_cores) // n_procs))
+    return n_procs, n_threads
+
+
 def _get_dsynth_book(args):
     if len(args) < 4:
         raise ValueError('Expected at least 3 arguments (pcap, date, pids)')
@@ -25,41 +205,104 @@ def _get_dsynth_book(args):
     pids = args[2]
     symbols = args[3]
     log_level = args[4] if len(args) > 4 else 0
+    opts = args[5] if len(args) > 5 else {}
     logger = Logger(log_level)
     logger.log(f'Processing {date}', 0)
 
+    columns = opts.get('columns')
+    if columns is not None:
+        columns = set(columns) | {'symbol', 'eid', 't_time'}
+    tod_range = opts.get('tod_range')
+    tod_filter = None
+    if tod_range is not None:
+        # time of day is relative to the start of the session (the day before the
+        # market date), like the sniper opps' t_tod
+        session_start = pd.Timestamp(date) - pd.Timedelta('1d')
+        tod_filter = _get_range_filter(
+            't_time', *[
+                None if x is None else session_start + pd.Timedelta(x)
+                for x in tod_range
+            ])
+    eid_range = opts.get('eid_range')
+    eid_filter = None
+    if eid_range is not None:
+        eid_filter = _get_range_filter('eid', *eid_range)
+    psb_filter = _and_filters(tod_filter, eid_filter)
+
     def get_psynth_book(pid):
         logger.log(f'[{date}] Processing {date} polygon {pid}', 1)
         try:
-            psb = pd.read_feather(
+            psb = _read_feather(
                 pcap.feather_file_path(
-                    name=f'synthetic_book_{pid}', date=date))
+                    name=f'synthetic_book_{pid}', date=date), columns,
+                psb_filter)
         except Exception as e:
             logger.log(f'Error processing {date} polygon {pid}: {e}', 3)
             return None
         psb['market_date'] = pd.Timestamp(date)
-        psb['bk_dur'] = psb.shift(-1)['t_time'] - psb['t_time']
         return psb
 
-    sbs = [get_psynth_book(p) for p in pids]
+    n_threads = opts.get('n_threads') or 1
+    if n_threads > 1 and len(pids) > 1:
+        with ThreadPool(min(n_threads, len(pids))) as p:
+            sbs = p.map(get_psynth_book, pids)
+    else:
+        sbs = [get_psynth_book(p) for p in pids]
     logger.log(f'[{date}] Concatenating synth books...', 0)
-    sb_df = pd.concat(objs=[sb for sb in sbs if sb is not None])
-    if symbols is not None:
-        sb_df['symbol'] = pd.Categorical(sb_df['symbol'], categories=symbols)
+    sbs = [sb for sb in sbs if sb is not None]
+    if not sbs:
+        raise ValueError(f'[{date}] Unable to read any synth books')
+    # (if the ranges exclude every book, an empty frame (with the polygons' columns) is
+    # loaded, so the date gets an empty (but correctly indexed) synth book)
+    empty_sbs = sbs[:1]
+    sbs = [sb for sb in sbs if len(sb) > 0]
+    if opts.get('categories') is not None:
+        # (the shared dictionary of the compact schema; the symbols only select the pids)
+        categories = opts['categories']
+    elif symbols is not None:
+        categories = pd.Index(ensure_iterable(symbols))
     else:
-        sb_df['symbol'] = sb_df['symbol'].astype('category')
+        categories = pd.Index(
+            sorted(set().union(*[sb['symbol'].unique() for sb in sbs])))
+    # Each polygon's books are eid-ordered, so ordering the polygons by symbol (the
+    # result's index order) yields a sorted frame without a global sort.
+    sbs.sort(key=lambda sb: categories.get_indexer([sb['symbol'].iat[0]])[0])
+    sb_df = pd.concat(objs=sbs or empty_sbs, ignore_index=True)
+    sb_df['symbol'] = pd.Categorical(sb_df['symbol'], categories=categories)
+    sym_codes = sb_df['symbol'].cat.codes.to_numpy()
+    eid = sb_df['eid'].to_numpy()
+    d_codes = np.diff(sym_codes)
+    if not np.all((d_codes > 0) | ((d_codes == 0) & (np.diff(eid) >= 0))):
+        logger.log(f'[{date}] Synth books are not in (symbol, eid) order', 2)
+        sb_df = sb_df.take(np.lexsort((eid, sym_codes)))
+        eid = sb_df['eid'].to_numpy()
+        sym_codes = sb_df['symbol'].cat.codes.to_numpy()
+    next_t_time = _get_next_t_time(sb_df['t_time'].to_numpy(), sym_codes)
+    sb_df['bk_dur'] = next_t_time - sb_df['t_time'].to_numpy()
 
     logger.log(f'[{date}] Loading event info...', 0)
-    ei = pd.read_feather(pcap.feather_file_path(
-        name='event_info', date=date)).drop(columns='t_time')
+    ei_columns = None if columns is None else columns - {'t_time'}
+    ei = _read_feather(
+        pcap.feather_file_path(name='event_info', date=date), ei_columns,
+        eid_filter)
+    if 't_time' in ei:
+        ei = ei.drop(columns='t_time')
 
     logger.log(f'[{date}] Merging event info...', 0)
-    sb_df = pd.merge(sb_df, ei.rename(columns={'eid': 'eidr'}), left_on='eid', right_on='eidr', how='left')\
-        .drop(columns='eidr')\
-        .set_index(['market_date', 'symbol', 'eid'])\
-        .sort_index()
-    sb_df['bk_dur_lsn'] = sb_df.shift(-1)['t_time'] - sb_df['ls_time']
-    sb_df['bk_dur_fsn'] = sb_df.shift(-1)['t_time'] - sb_df['fs_time']
+    for c, vals in _take_event_info(ei, eid).items():
+        sb_df[c] = vals
+    if opts.get('tick_sizes') is not None:
+        off_grid_cols = _to_compact_schema(
+            sb_df, sym_codes, categories, opts['tick_sizes'])
+        if off_grid_cols:
+            logger.log(
+                f'[{date}] Prices of {off_grid_cols} are off the tick grid (left as float)',
+                2)
+    sb_df = sb_df.set_index(['market_date', 'symbol', 'eid'])
+    if 'ls_time' in sb_df:
+        sb_df['bk_dur_lsn'] = next_t_time - sb_df['ls_time'].to_numpy()
+    if 'fs_time' in sb_df:
+        sb_df['bk_dur_fsn'] = next_t_time - sb_df['fs_time'].to_numpy()
     return sb_df
 
 
@@ -82,6 +325,14 @@ class SyntheticBookLoader:
     def __pick_log_level(kwargs, default=1):
         return kwarg_picker.pick_or(kwargs, default, 'log_level', 'log', 'll')
 
+    @staticmethod
+    def __pick_read_opts(kwargs):
+        return {
+            'columns': kwarg_picker.pick(kwargs, 'columns', 'cols'),
+            'tod_range': kwarg_picker.pick(kwargs, 'tod_range', 'tod'),
+            'eid_range': kwarg_picker.pick(kwargs, 'eid_range', 'eids')
+        }
+
     def __init__(
             self, channel: int, synthetic_security_df: pd.DataFrame, **kwargs):
         self.__channel = channel
@@ -90,6 +341,9 @@ class SyntheticBookLoader:
         self.__symbols = SyntheticBookLoader.__pick_symbols(kwargs)
         self.__market_dates = SyntheticBookLoader.__pick_market_dates(kwargs)
         self.__log_level = SyntheticBookLoader.__pick_log_level(kwargs)
+        self.__schema = kwarg_picker.pick(kwargs, 'schema')
+        self.__tick_size_col = kwarg_picker.pick_or(
+            kwargs, 'tick_size', 'tick_size_col')
 
         n_levels = SyntheticBookLoader.__pick_n_levels(kwargs)
         if channel is None:
@@ -111,7 +365,43 @@ class SyntheticBookLoader:
         symbols = ensure_iterable(symbols)
         return ss_df.loc[ss_df['symbol'].isin(symbols)]['id']
 
+    def tick_sizes(self):
+        """Gets the tick size of each symbol (a dict)"""
+        ss_df = self.__synthetic_security_df
+        if self.__tick_size_col not in ss_df:
+            raise ValueError(
+                f"The synthetic securities have no '{self.__tick_size_col}' column")
+        return dict(zip(ss_df['symbol'], ss_df[self.__tick_size_col]))
+
+    def __get_schema_opts(self, kwargs):
+        """Gets the read opts of the specified schema (None or 'compact').  The compact
+        schema stores prices as int32 ticks, quantities as uint32, and uses every
+        synthetic security symbol as the symbol categories, so that dates share one
+        symbol dictionary.  pandas sizes the codes to the dictionary: int16 up to 32767
+        symbols, int32 beyond (uint16 codes aren't possible, as pandas categorical codes
+        are signed)."""
+        schema = kwarg_picker.pick_or(kwargs, self.__schema, 'schema')
+        if schema is None:
+            return {}
+        if schema != 'compact':
+            raise ValueError(f"Unknown schema '{schema}' (expected 'compact')")
+        return {
+            'tick_sizes': self.tick_sizes(),
+            'categories': pd.Index(
+                sorted(self.__synthetic_security_df['symbol'].unique()))
+        }
+
     def load_synth_book(self, **kwargs):
+        """Loads the synth books of the polygons (symbols) on the market dates, indexed by
+        (market_date, symbol, eid).  Reads can be limited with:
+          columns: the synth book/event info columns to read (symbol, eid and t_time are
+            always read)
+          tod_range: (start, stop) time of day (relative to the start of the session, like
+            the sniper opps' t_tod); either may be None
+          eid_range: (start, stop) eids; either may be None
+        schema='compact' stores prices as int32 ticks and quantities as uint32 (see
+        from_ticks to convert prices back); price columns off the tick grid stay float.
+        Note that the bk_dur of a polygon's last book within a range is NaT."""
         log_level = SyntheticBookLoader.__pick_log_level(
             kwargs, self.__log_level)
         logger = Logger(log_level)
@@ -127,6 +417,16 @@ class SyntheticBookLoader:
         n_levels = SyntheticBookLoader.__pick_n_levels(kwargs, self.__n_levels)
 
         pcap = PCapLocationParams(self.__channel)
+        opts = SyntheticBookLoader.__pick_read_opts(kwargs)
+        opts.update(self.__get_schema_opts(kwargs))
+        market_dates = ensure_iterable(market_dates)
+        n_procs, opts['n_threads'] = get_worker_counts(
+            len(market_dates) if load_in_parallel else 1, len(pids))
+        opts['n_threads'] = kwarg_picker.pick_or(
+            kwargs, opts['n_threads'], 'n_threads')
+        logger.log(
+            f'Loading with {n_procs if load_in_parallel else 1} processes x '
+            f'{opts["n_threads"]} threads')
         all_synth_books = []
         # if len(pids) > 12:
         #     raise ValueError(f'Too many pids ({len(pids)})')
@@ -137,14 +437,14 @@ class SyntheticBookLoader:
                 log_level=1, logger=logger):
 
             if load_in_parallel:
-                with Pool(cpu_count()) as p:
+                with Pool(n_procs) as p:
                     # chunks = chunker.get_chunks(market_dates, 4)
                     all_synth_books = p.map(
-                        _get_dsynth_book, [(pcap, d, pids, symbols, log_level)
+                        _get_dsynth_book, [(pcap, d, pids, symbols, log_level, opts)
                                            for d in market_dates])
             else:
                 all_synth_books = [
-                    _get_dsynth_book((pcap, d, pids, symbols, log_level))
+                    _get_dsynth_book((pcap, d, pids, symbols, log_level, opts))
                     for d in market_dates
                 ]
 
@@ -153,3 +453,56 @@ class SyntheticBookLoader:
                     log_level=1, logger=logger):
                 result = pd.concat(objs=all_synth_books)
                 return result
+
+    def iter_synth_books(self, **kwargs):
+        """Yields (market_date, synth_book) one date at a time (or, if pid_batch_sz is
+        specified, one batch of polygons of a date at a time), rather than loading the
+        entire date range into memory.  The next 'prefetch' (default 1) items are loaded
+        by a background thread while the caller processes the current one.  Accepts
+        the same read options as load_synth_book."""
+        log_level = SyntheticBookLoader.__pick_log_level(
+            kwargs, self.__log_level)
+        market_dates = SyntheticBookLoader.__pick_market_dates(
+            kwargs, self.__market_dates)
+        if market_dates is None:
+            raise ValueError('market_dates cannot be None')
+
+        symbols = SyntheticBookLoader.__pick_symbols(kwargs, self.__symbols)
+        pids = list(self.get_polygon_ids(symbols=symbols))
+        pid_batch_sz = kwarg_picker.pick(kwargs, 'pid_batch_sz', 'batch_sz')
+        pid_batches = [pids] if pid_batch_sz is None else list(
+            get_chunks(pids, pid_batch_sz))
+        prefetch = kwarg_picker.pick_or(kwargs, 1, 'prefetch')
+
+        pcap = PCapLocationParams(self.__channel)
+        opts = SyntheticBookLoader.__pick_read_opts(kwargs)
+        opts.update(self.__get_schema_opts(kwargs))
+        opts['n_threads'] = kwarg_picker.pick_or(
+            kwargs,
+            get_worker_counts(1, max(map(len, pid_batches)))[1], 'n_threads')
+        all_args = [(pcap, d, b, symbols, log_level, opts)
+                    for d in ensure_iterable(market_dates) for b in pid_batches]
+        if prefetch < 1:
+            for args in all_args:
+                yield args[1], _get_dsynth_book(args)
+            return
+
+        # Threads (rather than processes) avoid pickling the loaded frames back to the
+        # caller, and the feather reads release the GIL
+        with ThreadPool(prefetch) as p:
+            pending = deque()
+            arg_it = iter(all_args)
+            for args in arg_it:
+                pending.append((args[1], p.apply_async(_get_dsynth_book, (args, ))))
+                if len(pending) >= prefetch:
+                    break
+            while pending:
+                date, result = pending.popleft()
+                dsb = result.get()
+                # (queued once the current item is loaded, so at most 'prefetch' items are
+                # loaded while the caller holds it)
+                args = next(arg_it, None)
+                if args is not None:
+                    pending.append(
+                        (args[1], p.apply_async(_get_dsynth_book, (args, ))))
+                yield date, dsb
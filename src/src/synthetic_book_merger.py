@@ -1,13 +1,105 @@
 from src.core.logger import Logger
 import src.core.kwarg_picker as kwarg_picker
-# from src.core.stopwatch import Stopwatch
+from src.core.stopwatch import Stopwatch
 from src.core.stopwatch_logger import StopwatchLogger
 from src.core.chunker import get_chunks
+from src.core.shared_arrays import SharedArrays
+from src.synthetic_book_index import SyntheticBookIndex
+from src.merged_opp_book_cache import hash_opp_source, hash_synth_book_source
 import pandas as pd
 # from pandarallel import pandarallel
 import numpy as np
 # import traceback
 from multiprocessing import Pool, cpu_count
+import os
+
+
+def _get_opp_keys(date_opp):
+    """Gets the distinct (market_date, symbol, opp_start_eid) keys of the opps, sorted"""
+    return date_opp.index[~date_opp.index.duplicated()].sortlevel(
+        ['market_date', 'symbol', 'opp_start_eid'])[0]
+
+
+def _get_opp_window_columns(date_index, starts, stops):
+    """Gets the opp (position) and synth book row of each row of the merged opp book, along
+    with the opp_dur*, side (codes) and edge columns.  Opps with an empty [start, stop)
+    range are omitted."""
+    lens = stops - starts
+    opp_idx = np.repeat(np.arange(len(starts)), lens)
+    rows = np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+    start_rows = starts[opp_idx]
+
+    sb = date_index.arrays
+    sb_start_time = sb['t_time'][start_rows]
+    opp_dur = sb['t_time'][rows] - sb_start_time
+    opp_dur_fsn = opp_dur - (sb['fs_time'][start_rows] - sb_start_time)
+    opp_dur_lsn = opp_dur - (sb['ls_time'][start_rows] - sb_start_time)
+    bk_dur = sb['bk_dur'][rows]
+    ask_p_1 = sb['ask_p_1'][rows]
+    bid_p_1 = sb['bid_p_1'][rows]
+    cols = {
+        'opp_dur': opp_dur,
+        'opp_dur_fsn': opp_dur_fsn,
+        'opp_dur_lsn': opp_dur_lsn,
+        # The amount of 'opp time' until the next bk changes.  This will be handy
+        # when looking at the bk updates that occur within some fixed time period
+        # of the opp beginning, as the row representing the last bk update within
+        # such a window will indicate exactly how long the book persists.
+        'opp_dur_thru': opp_dur + bk_dur,
+        'opp_dur_thru_fsn': opp_dur_fsn + bk_dur,
+        'opp_dur_thru_lsn': opp_dur_lsn + bk_dur,
+        # -1 (no edge), 0 (Buy), 1 (Sell), 2 (Invalid)
+        'side': (np.where(ask_p_1 < 0, 1, 0) + np.where(bid_p_1 > 0, 2, 0) - 1)
+        .astype('int8'),
+        'edge': np.maximum(-ask_p_1, bid_p_1)
+    }
+    return opp_idx, rows, cols
+
+
+def _to_merged_opp_book(date_sb, sb_eid, opp_keys, opp_idx, rows, window_cols):
+    """Builds the merged opp book, indexed by (market_date, symbol, opp_start_eid,
+    synth_bk_eid)"""
+    rv = date_sb.take(rows)
+    rv.index = pd.MultiIndex.from_arrays(
+        [opp_keys.get_level_values(i)[opp_idx] for i in range(0, 3)] +
+        [pd.Index(sb_eid[rows], name='synth_bk_eid')])
+    for c, vals in window_cols.items():
+        if c == 'side':
+            vals = pd.Categorical.from_codes(
+                vals, categories=['Buy', 'Sell', 'Invalid'])
+        rv[c] = vals
+    return rv
+
+
+def _get_shared_date_index(shared, i):
+    """Gets the SyntheticBookIndex of the date (position) published by SyntheticBookMerger
+    (views of the shared arrays).  Symbols are published as their (per-date) codes."""
+    sb_lo, sb_hi = shared['sb_date_offsets'][i:i + 2]
+    sym_lo, sym_hi = shared['sym_date_offsets'][i:i + 2]
+    return SyntheticBookIndex(
+        symbols=range(0, sym_hi - sym_lo - 1),
+        offsets=shared['sym_offsets'][sym_lo:sym_hi] - sb_lo,
+        eid=shared['eid'][sb_lo:sb_hi],
+        **{c: shared[c][sb_lo:sb_hi] for c in SyntheticBookIndex.columns})
+
+
+def _merge_shared_dates(args):
+    """Pool worker: locates the opp windows of the specified dates (positions) from the
+    synth book/opp arrays published by SyntheticBookMerger.  Only the [start, stop) rows
+    of each opp are returned (the window columns are built by the caller from the shared
+    arrays).  Returns (pid, elapsed, [(date_pos, starts, stops)...])."""
+    shared, date_positions, delay = args
+    stopwatch = Stopwatch()
+    stopwatch.start()
+    results = []
+    for i in date_positions:
+        opp_lo, opp_hi = shared['opp_date_offsets'][i:i + 2]
+        starts, stops = _get_shared_date_index(shared, i).locate_opp_windows(
+            shared['opp_symbol'][opp_lo:opp_hi],
+            shared['opp_start_eid'][opp_lo:opp_hi], delay)
+        results.append((i, starts, stops))
+    stopwatch.stop()
+    return os.getpid(), stopwatch.elapsed(), results
 
 
 class SyntheticBookMerger:
@@ -24,62 +116,85 @@ class SyntheticBookMerger:
         self.__show_all_changes = show_all_changes
         self.__log_level = log_level
 
+    def date_index(self, date):
+        """Gets the per-symbol synth book arrays for the date.  They're copies of the date's
+        synth book, so they aren't cached (callers build, use and drop them)."""
+        return SyntheticBookIndex.from_synth_book(
+            self.__synth_bk_date_groupby.get_group(date))
+
     def merge_date(self, date):
         date_opp = self.__opp_date_groupby.get_group(date)
         date_sb = self.__synth_bk_date_groupby.get_group(date)
         logger = Logger(self.__log_level)
         logger.log(f'Adding synth books for {date}', 0)
 
-        def impl(x):
-            symbol = x.name[1]
-            opp_start_eid = x.name[2]
-            sb = date_sb.loc[date, symbol, :]
-            sb = sb.reset_index(['eid', 'market_date', 'symbol'])\
-                .drop(columns=['market_date', 'symbol'])\
-                .rename(columns={'eid': 'synth_bk_eid'})
-
-            sb_start_idx = sb.loc[
-                sb['synth_bk_eid'] <= opp_start_eid]['synth_bk_eid'].idxmax()
-            sb_start_eid = sb.iloc[sb_start_idx]['synth_bk_eid']
-            sb_start_time = sb.iloc[sb_start_idx]['t_time']
-            sb_start_time_fsn = sb.iloc[sb_start_idx]['fs_time']
-            sb_start_time_lsn = sb.iloc[sb_start_idx]['ls_time']
-            sn_delta_fsn = sb_start_time_fsn - sb_start_time
-            sn_delta_lsn = sb_start_time_lsn - sb_start_time
-            sb_stop_time = sb_start_time + self.__delay
-            sb = sb.loc[(sb['synth_bk_eid'] >= sb_start_eid)
-                        & (sb['t_time'] <= sb_stop_time)]
-            sb['opp_dur'] = sb['t_time'] - sb_start_time
-            sb['opp_dur_fsn'] = sb['opp_dur'] - sn_delta_fsn
-            sb['opp_dur_lsn'] = sb['opp_dur'] - sn_delta_lsn
-            # The amount of 'opp time' until the next bk changes.  This will be handy
-            # when looking at the bk updates that occur within some fixed time period
-            # of the opp beginning, as the row representing the last bk update within
-            # such a window will indicate exactly how long the book persists.
-            sb['opp_dur_thru'] = sb['opp_dur'] + sb['bk_dur']
-            sb['opp_dur_thru_fsn'] = sb['opp_dur_fsn'] + sb['bk_dur']
-            sb['opp_dur_thru_lsn'] = sb['opp_dur_lsn'] + sb['bk_dur']
-
-            # Add opp side, and edge.  This could prob be better optimized
-            is_buy_opp = np.where(sb['ask_p_1'] < 0, 1, 0)
-            is_sell_opp = np.where(sb['bid_p_1'] > 0, 2, 0)
-            sb['side'] = np.choose(
-                is_buy_opp + is_sell_opp, [None, 'Buy', 'Sell', 'Invalid'])
-            sb['side'] = sb['side'].astype('category')
-            sb['edge'] = np.max([-sb['ask_p_1'], sb['bid_p_1']], axis=0)
-            return sb
-
-        rv = date_opp.groupby(
-            level=['market_date', 'symbol', 'opp_start_eid']).apply(impl)
-        rv = rv.set_index([rv.index.get_level_values(i)
-                           for i in range(0, 3)] + ['synth_bk_eid'])
-        return rv
+        opp_keys = _get_opp_keys(date_opp)
+        date_index = self.date_index(date)
+        starts, stops = date_index.locate_opp_windows(
+            opp_keys.get_level_values('symbol'),
+            opp_keys.get_level_values('opp_start_eid'), self.__delay)
+        n_unlocated = np.count_nonzero(stops == starts)
+        if n_unlocated > 0:
+            logger.log(
+                f'[{date}] Unable to locate synth books for {n_unlocated} opps', 2)
+        return _to_merged_opp_book(
+            date_sb, date_index.eid, opp_keys,
+            *_get_opp_window_columns(date_index, starts, stops))
 
     def merge_dates(self, dates):
         results = [self.merge_date(d) for d in dates]
         return pd.concat(objs=results)
 
+    def __publish(self, dates, opp_keys):
+        """Publishes the synth book index and opp key arrays of the dates in shared memory.
+        Each date's index is built, copied into the (preallocated) synth book arrays and
+        dropped, so only one date's index is held at a time."""
+        sb_indices = self.__synth_bk_date_groupby.indices
+        sb_date_offsets = np.r_[0, np.cumsum([len(sb_indices[d]) for d in dates])]
+        shared = None
+        sym_offsets = []
+        opp_symbols = []
+        try:
+            for i, (d, k) in enumerate(zip(dates, opp_keys)):
+                di = self.date_index(d)
+                if shared is None:
+                    shared = SharedArrays.allocate({
+                        c: (a.dtype, (sb_date_offsets[-1], ))
+                        for c, a in [*di.arrays.items(), ('eid', di.eid)]
+                    })
+                lo, hi = sb_date_offsets[i:i + 2]
+                for c, a in di.arrays.items():
+                    shared[c][lo:hi] = a
+                shared['eid'][lo:hi] = di.eid
+                sym_offsets.append(di.offsets + lo)
+                opp_symbols.append(
+                    pd.Index(di.symbols).get_indexer(k.get_level_values('symbol')))
+                del di
+            if shared is None:
+                shared = SharedArrays.allocate({})
+            shared.add('sb_date_offsets', sb_date_offsets)
+            shared.add('sym_offsets', np.concatenate(sym_offsets or [[]]).astype('int64'))
+            shared.add(
+                'sym_date_offsets', np.r_[0, np.cumsum([len(o) for o in sym_offsets])])
+            shared.add(
+                'opp_symbol', np.concatenate(opp_symbols or [[]]).astype('int64'))
+            shared.add(
+                'opp_start_eid',
+                np.concatenate([
+                    k.get_level_values('opp_start_eid').to_numpy() for k in opp_keys
+                ] or [[]]).astype('int64'))
+            shared.add(
+                'opp_date_offsets', np.r_[0, np.cumsum([len(k) for k in opp_keys])])
+        except Exception:
+            if shared is not None:
+                shared.close()
+            raise
+        return shared
+
     def merge(self, **kwargs):
+        """Merges the opps with their synth book windows.  The synth book's columns are
+        kept as is, so for a compact schema synth book, prices and 'edge' are in ticks (see
+        synthetic_book_loader.from_ticks)."""
         load_in_parallel = kwargs.get('load_in_parallel') or kwargs.get(
             'parallel') or False
         delay = kwargs.get('delay')
@@ -95,16 +210,72 @@ class SyntheticBookMerger:
             log_level = self.__log_level
 
         logger = Logger(log_level)
-        dates = list(self.__opp_date_groupby.groups)
+        all_dates = list(self.__opp_date_groupby.groups)
+        cache = kwarg_picker.pick(kwargs, 'cache')
+        cached = {}
+        opp_hashes = {}
+        sb_hashes = {}
+        if cache is not None:
+            opp_source = kwarg_picker.pick(kwargs, 'opp_source')
+            for d in all_dates:
+                opp_hashes[d] = hash_opp_source(
+                    self.__opp_date_groupby.get_group(d), opp_source)
+                sb_hashes[d] = hash_synth_book_source(
+                    self.__synth_bk_date_groupby.get_group(d))
+                df = cache.read(
+                    d, self.__delay, self.__show_all_changes, opp_hashes[d],
+                    sb_hashes[d])
+                if df is not None:
+                    cached[d] = df
+            logger.log(
+                f'Read {len(cached)} of {len(all_dates)} dates from the merged opp book cache',
+                1)
+        dates = [d for d in all_dates if d not in cached]
 
         def series_impl():
             """Gets a 1:1 list of synth-book-data:date"""
             return list(map(self.merge_date, dates))
 
-        def parallel_impl(date_chunks):
-            """Gets a 1:1 list of synth-book-data:date_chunk"""
-            with Pool(cpu_count()) as p:
-                return p.map(self.merge_dates, date_chunks)
+        def parallel_impl(chunk_sz):
+            """Gets a 1:1 list of synth-book-data:date.  Rather than pickling the merger
+            (and its groupbys) into each worker, the synth book/opp arrays are published
+            once in shared memory, and the workers only get date positions.  The workers
+            only locate the opp windows (returning two ints per opp), and the merged books
+            are built here from the shared arrays."""
+            opp_keys = [
+                _get_opp_keys(self.__opp_date_groupby.get_group(d))
+                for d in dates
+            ]
+            with StopwatchLogger('publish synth book arrays',
+                                 log_level=log_level):
+                shared = self.__publish(dates, opp_keys)
+            rv = [None] * len(dates)
+            with shared:
+                logger.log(
+                    f'Published {shared.nbytes() / 1e6:,.1f}MB of synth book arrays')
+                date_pos_chunks = get_chunks(list(range(0, len(dates))), chunk_sz)
+                with Pool(cpu_count()) as p:
+                    worker_results = p.map(
+                        _merge_shared_dates,
+                        [(shared, c, pd.Timedelta(self.__delay).value)
+                         for c in date_pos_chunks])
+                for pid, elapsed, results in worker_results:
+                    logger.log(
+                        f'Worker {pid} located opps for {len(results)} dates in {elapsed}',
+                        1)
+                    for i, starts, stops in results:
+                        date = dates[i]
+                        n_unlocated = np.count_nonzero(stops == starts)
+                        if n_unlocated > 0:
+                            logger.log(
+                                f'[{date}] Unable to locate synth books for {n_unlocated} opps',
+                                2)
+                        date_index = _get_shared_date_index(shared, i)
+                        rv[i] = _to_merged_opp_book(
+                            self.__synth_bk_date_groupby.get_group(date),
+                            date_index.eid, opp_keys[i],
+                            *_get_opp_window_columns(date_index, starts, stops))
+            return rv
 
         def impl():
             if load_in_parallel:
@@ -118,8 +289,7 @@ class SyntheticBookMerger:
                     logger.log(
                         f'Processing in parallel: {num_chunks} chunks of size {chunk_sz} (rem {len(dates) % chunk_sz})'
                     )
-                    date_chunks = get_chunks(dates, chunk_sz)
-                    return parallel_impl(date_chunks)
+                    return parallel_impl(chunk_sz)
                 logger.log(
                     'Processing in sequence (insufficient data to justify parallel processing)'
                 )
@@ -127,7 +297,14 @@ class SyntheticBookMerger:
 
         with StopwatchLogger(f'merge opp books for {len(dates)} dates',
                              log_level=log_level):
-            merged_date_chunks = impl()
+            merged = dict(zip(dates, impl() if dates else []))
+            if cache is not None:
+                for d, df in merged.items():
+                    cache.write(
+                        d, df, self.__delay, self.__show_all_changes,
+                        opp_hashes[d], sb_hashes[d])
+            merged.update(cached)
+            merged_date_chunks = [merged[d] for d in all_dates]
             with StopwatchLogger(
                     f'concatenate date-opp-book chunks ({len(merged_date_chunks)})',
                     log_level=log_level):
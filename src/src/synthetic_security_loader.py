@@ -1,10 +1,40 @@
 from src.core.postgres_connection import PostgresConnection
 from src.core.iter_utils import ensure_iterable
+from src.reference_data_snapshot import read_reference_data
 
-import math
+import numpy as np
 import pandas as pd
 
 
+class SyntheticFeeLookup:
+    """Array lookup of the fees of synthetic securities (sids), with one fee per member
+    type, so fees can be gathered for many rows without merging DataFrames"""
+
+    def __init__(self, fees: pd.DataFrame):
+        """'fees' is a SyntheticSecurityLoader.load_fees result"""
+        self.member_types = [c for c in fees.columns if c != 'id']
+        sids = fees.index.to_numpy()
+        order = np.argsort(sids, kind='stable')
+        self.sids = sids[order]
+        self.fees = fees[self.member_types].to_numpy(dtype='float64')[order]
+
+    def member_type_idx(self, member_type):
+        return self.member_types.index(member_type)
+
+    def get(self, sids, member_type=None):
+        """Gets the fee vectors (n x n_member_types) of the sids, or just the member type's
+        fees (n) if specified.  Unknown sids get NaN fees."""
+        sids = np.asarray(sids)
+        fees = self.fees if member_type is None else self.fees[:, self.member_type_idx(
+            member_type)]
+        rv = np.full((len(sids), ) + fees.shape[1:], np.nan)
+        pos = np.searchsorted(self.sids, sids)
+        is_known = pos < len(self.sids)
+        is_known[is_known] = self.sids[pos[is_known]] == sids[is_known]
+        rv[is_known] = fees[pos[is_known]]
+        return rv
+
+
 class SyntheticSecurityLoader:
     def __init__(self, **kwargs):
         self.__symbols = ensure_iterable(
@@ -12,10 +42,17 @@ class SyntheticSecurityLoader:
             or kwargs.get('syms'), None)
         self.__pg_conn = kwargs.get('pg_conn') or kwargs.get(
             'conn') or PostgresConnection(host='titan')
+        # None disables the (on-disk) reference data snapshot
+        self.__snapshot_ttl = kwargs.get('snapshot_ttl', '1d')
         self.__result = None
+        self.__synth_fee = None
+        self.__fee_lookup = None
 
     @staticmethod
     def load_fees(synthetic_security_leg, fee):
+        """Gets the fee of each synthetic security (sid), per member type: the sum of its
+        legs' n_legs * fee (NaN if the sid has no fee for the member type).  The index is
+        the sid, and the columns are 'id' followed by the member types."""
         synth_fee = pd.merge(
             synthetic_security_leg,
             fee,
@@ -24,35 +61,38 @@ class SyntheticSecurityLoader:
         synth_fee['fee'] = synth_fee['n_legs'] * synth_fee['fee']
         member_types = synth_fee['member_type'].unique()
 
-        def impl(x):
-            by_member_type = x.groupby('member_type')
-
-            def get_member_type_fee(mt):
-                if mt in by_member_type.groups:
-                    mtg = by_member_type.get_group(mt)
-                    return mtg['fee'].sum()
-                return math.nan
-
-            data = {'id': [x.name]}
-            for mt in member_types:
-                data[mt] = [get_member_type_fee(mt)]
-            return pd.DataFrame(data=data)
-
-        res = synth_fee.groupby('sid').apply(impl)
-        res = res.set_index(res.index.get_level_values('sid'))
+        # (sids without any matching fee are kept, with all NaN fees)
+        res = synth_fee.groupby(['sid', 'member_type'])['fee'].sum().unstack(
+            'member_type').reindex(
+                index=np.unique(synth_fee['sid'].dropna()), columns=member_types)
+        res.index.name = 'sid'
+        res.columns.name = None
+        res.insert(0, 'id', res.index.to_numpy())
         return res
 
+    def fee_lookup(self):
+        """Gets the (cached) SyntheticFeeLookup of the synthetic securities"""
+        if self.__fee_lookup is None:
+            self.result()
+            self.__fee_lookup = SyntheticFeeLookup(self.__synth_fee)
+        return self.__fee_lookup
+
     def result(self):
         if self.__result is None:
-            conn = self.__pg_conn.connect()
-            synth_leg = pd.read_sql(
-                'select * from synthetic_security_leg',
-                conn).drop(columns='index')
-            product_fee = pd.read_sql('select * from product_fee',
-                                      conn).drop(columns='index')
+            ref_data = read_reference_data(
+                self.__pg_conn.connect, {
+                    'synthetic_security_leg': 'select * from synthetic_security_leg',
+                    'product_fee': 'select * from product_fee',
+                    'synthetic_security': 'select * from synthetic_security'
+                },
+                getattr(self.__pg_conn, 'host', 'default'),
+                ttl=self.__snapshot_ttl)
+            synth_leg = ref_data['synthetic_security_leg'].drop(columns='index')
+            product_fee = ref_data['product_fee'].drop(columns='index')
             synth_fee = SyntheticSecurityLoader.load_fees(
                 synth_leg, product_fee)
-            synth_sec = pd.read_sql('select * from synthetic_security', conn)
+            self.__synth_fee = synth_fee
+            synth_sec = ref_data['synthetic_security']
             if self.__symbols is not None:
                 synth_sec = synth_sec.loc[synth_sec['symbol'].isin(
                     self.__symbols)]
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.sniper_opp_dur_summarizer import OppDurSketchStore, build_dur_sketches, \
+    compare_sketch_to_exact, get_opp_dur_summary, get_sketch_dur_summary
+
+
+def make_opps(n=50000, n_dates=5, n_symbols=20, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2023-01-02', periods=n_dates)
+    index = pd.MultiIndex.from_arrays(
+        [
+            rng.choice(dates.to_numpy(), n),
+            rng.choice([f'S{i}' for i in range(n_symbols)], n),
+            np.arange(n)
+        ],
+        names=['market_date', 'symbol', 'eid'])
+    opps = pd.DataFrame(
+        {
+            'lsn_win': pd.to_timedelta(rng.lognormal(10, 2, n).astype('int64'), 'ns'),
+            # (including negative and zero durations)
+            'fsn_win': pd.to_timedelta(
+                (rng.lognormal(8, 3, n) - 100).astype('int64'), 'ns')
+        },
+        index=index)
+    opps.iloc[::97, 1] = pd.NaT
+    return opps
+
+
+@pytest.mark.parametrize('alpha', [0.01, 0.001])
+def test_sketch_quantiles_within_bound(alpha):
+    cmp = compare_sketch_to_exact(make_opps(), alpha=alpha)
+    assert len(cmp) == 20 * 2 * 9
+    assert cmp['is_within_bound'].all()
+
+
+def test_sketch_summary_layout():
+    opps = make_opps()
+    exact = get_opp_dur_summary(opps.groupby('symbol'))
+    approx = get_sketch_dur_summary(build_dur_sketches(opps))
+    assert list(approx.columns) == list(exact.columns)
+    assert (approx['n_opps'].to_numpy() == exact['n_opps'].to_numpy()).all()
+
+
+def test_store_merges_dates_and_chunks(tmp_path):
+    opps = make_opps()
+    start, end = '2023-01-03', '2023-01-05'
+    store = OppDurSketchStore('a', store_root=str(tmp_path), log_level=0)
+    assert store.update(opps) == 5
+    assert store.update(opps) == 0
+    chunked = OppDurSketchStore('b', store_root=str(tmp_path), log_level=0)
+    for chunk in np.array_split(np.arange(len(opps)), 3):
+        chunked.write(build_dur_sketches(opps.iloc[chunk]), merge=True)
+    summ = store.summary(start=start, end=end)
+    pd.testing.assert_frame_equal(summ, chunked.summary(start=start, end=end))
+
+    dates = opps.index.get_level_values('market_date')
+    in_range = opps.loc[(dates >= start) & (dates <= end)]
+    pd.testing.assert_frame_equal(
+        summ, get_sketch_dur_summary(build_dur_sketches(in_range)))
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.synthetic_book_merger import SyntheticBookMerger
+
+DELAY = pd.Timedelta('5000ns')
+
+
+def make_books(n_dates=2, symbols=('A B', 'C D', 'E F'), n=200, seed=0):
+    """Gets (opps, synth book) of a few symbols/dates.  Every opp has a prior book, and
+    some opps are duplicated (as opps of several runs may share a start eid)."""
+    rng = np.random.default_rng(seed)
+    sbs = []
+    opps = []
+    for d in range(n_dates):
+        date = pd.Timestamp('2021-06-01') + pd.Timedelta(days=d)
+        eid_all = rng.permutation(
+            np.sort(rng.choice(np.arange(1, 4 * n * len(symbols)), n * len(symbols),
+                               replace=False)))
+        for k, s in enumerate(symbols):
+            eids = np.sort(eid_all[k * n:(k + 1) * n])
+            t_time = pd.Series(
+                date + pd.to_timedelta(eids * 700 + rng.integers(0, 50, n), unit='ns'))
+            df = pd.DataFrame({
+                'market_date': date,
+                'symbol': s,
+                'eid': eids,
+                't_time': t_time.cummax().to_numpy(),
+                'bid_p_1': rng.normal(-1, 1, n).round(2),
+                'ask_p_1': rng.normal(1, 1, n).round(2)
+            })
+            df['fs_time'] = df['t_time'] - pd.to_timedelta(
+                rng.integers(100, 1000, n), unit='ns')
+            df['ls_time'] = df['t_time'] - pd.to_timedelta(
+                rng.integers(0, 100, n), unit='ns')
+            df['bk_dur'] = df['t_time'].shift(-1) - df['t_time']
+            sbs.append(df)
+            opp_eids = rng.choice(eids[3:], 15, replace=False) + rng.integers(0, 2, 15)
+            opps.append(
+                pd.DataFrame({
+                    'market_date': date,
+                    'symbol': s,
+                    'opp_start_eid': np.r_[opp_eids, opp_eids[:3]],
+                    'x': 1
+                }))
+    sb = pd.concat(sbs)
+    sb['symbol'] = pd.Categorical(sb['symbol'], categories=list(symbols))
+    sb = sb.set_index(['market_date', 'symbol', 'eid']).sort_index()
+    opp = pd.concat(opps)
+    opp['symbol'] = pd.Categorical(opp['symbol'], categories=list(symbols))
+    opp = opp.set_index(['market_date', 'symbol', 'opp_start_eid']).sort_index()
+    return opp, sb
+
+
+def merge_per_opp(opp, sb, delay):
+    """The per-opp merge that SyntheticBookMerger.merge_date replaced (with xs in place of
+    the loc slice, which pandas 1.5 doesn't support)"""
+    frames = []
+    for date, symbol, opp_start_eid in opp.index.unique():
+        sym_sb = sb.xs((date, symbol), level=['market_date', 'symbol']).reset_index()\
+            .rename(columns={'eid': 'synth_bk_eid'})
+        start_idx = sym_sb.loc[
+            sym_sb['synth_bk_eid'] <= opp_start_eid]['synth_bk_eid'].idxmax()
+        start = sym_sb.iloc[start_idx]
+        sym_sb = sym_sb.loc[(sym_sb['synth_bk_eid'] >= start['synth_bk_eid'])
+                            & (sym_sb['t_time'] <= start['t_time'] + delay)].copy()
+        sym_sb['opp_dur'] = sym_sb['t_time'] - start['t_time']
+        sym_sb['opp_dur_fsn'] = sym_sb['opp_dur'] - (start['fs_time'] - start['t_time'])
+        sym_sb['opp_dur_lsn'] = sym_sb['opp_dur'] - (start['ls_time'] - start['t_time'])
+        sym_sb['opp_dur_thru'] = sym_sb['opp_dur'] + sym_sb['bk_dur']
+        sym_sb['opp_dur_thru_fsn'] = sym_sb['opp_dur_fsn'] + sym_sb['bk_dur']
+        sym_sb['opp_dur_thru_lsn'] = sym_sb['opp_dur_lsn'] + sym_sb['bk_dur']
+        sym_sb['side'] = np.choose(
+            np.where(sym_sb['ask_p_1'] < 0, 1, 0) + np.where(sym_sb['bid_p_1'] > 0, 2, 0),
+            [None, 'Buy', 'Sell', 'Invalid'])
+        sym_sb['edge'] = np.max([-sym_sb['ask_p_1'], sym_sb['bid_p_1']], axis=0)
+        sym_sb.index = pd.MultiIndex.from_arrays(
+            [[date] * len(sym_sb),
+             pd.Categorical([symbol] * len(sym_sb), categories=sb.index.levels[1]),
+             [opp_start_eid] * len(sym_sb), sym_sb.pop('synth_bk_eid')],
+            names=['market_date', 'symbol', 'opp_start_eid', 'synth_bk_eid'])
+        frames.append(sym_sb)
+    return pd.concat(frames)
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_merge_matches_per_opp_merge(parallel):
+    opp, sb = make_books()
+    expected = merge_per_opp(opp, sb, DELAY)
+    merger = SyntheticBookMerger(
+        opp.groupby(level=0), sb.groupby(level=0), delay=DELAY, log_level=5)
+    actual = merger.merge(parallel=parallel, parallel_min_sz=2, min_chunk_sz=1)
+
+    pd.testing.assert_index_equal(actual.index, expected.index, exact=False)
+    assert list(actual.columns) == list(expected.columns)
+    for c in expected.columns:
+        if c == 'side':
+            # (now always categorical of Buy/Sell/Invalid, NaN where there's no edge)
+            assert list(actual[c].cat.categories) == ['Buy', 'Sell', 'Invalid']
+            assert (actual[c].astype(object).fillna('-').to_numpy() ==
+                    expected[c].astype(object).fillna('-').to_numpy()).all()
+        else:
+            pd.testing.assert_series_equal(actual[c], expected[c], check_dtype=False)